@@ -0,0 +1,165 @@
+import argparse
+import glob
+import json
+import logging
+import multiprocessing
+import os
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import datetime
+
+import requests
+
+import main
+import pipeline
+import rate_limiter
+
+# Account config (accounts/<name>.json), every key is optional and falls back to main.py (see main.Account):
+# {
+#     "chococard_username": "...", "chococard_password": "...",
+#     "zort_storename": "...", "zort_apikey": "...", "zort_apisecret": "${BRAND_A_ZORT_SECRET}",
+#     "vending_username": "...", "vending_password": "...", "vending_machines": ["VCM350..."],
+#     "chococard_branches": {"Samyan": [7485, 2209]},
+#     "sheets": {"HQ": {"url": "https://docs.google.com/..."}},
+#     "saimai_sku_mapping": {"EW-VD": "P_EW-INT"},
+#     "sources": ["chococard", "zort", "hq"],
+#     "canonical": true,
+#     "deadline": 1200
+# }
+# Strings may reference environment variables (${NAME}) so secrets can stay in .env
+
+REPORT_FILENAME = 'batch_report.json'
+
+def expand(value):
+    if isinstance(value, str):
+        return os.path.expandvars(value)
+    if isinstance(value, list):
+        return [expand(item) for item in value]
+    if isinstance(value, dict):
+        return {key: expand(item) for key, item in value.items()}
+    return value
+
+def load_accounts(config_dir, output_root):
+    """Read and check every account config once in the parent, returns {name: main.Account}."""
+    accounts = {}
+    for path in sorted(glob.glob(os.path.join(config_dir, '*.json'))):
+        name = os.path.splitext(os.path.basename(path))[0]
+        with open(path, encoding='utf-8') as file:
+            config = json.load(file)
+        try:
+            accounts[name] = main.Account(name, os.path.join(output_root, name), **expand(config))
+        except ValueError as e:
+            raise ValueError(f"{path}: {e}") from None
+    if not accounts:
+        raise ValueError(f"No account configs found in {config_dir}")
+    return accounts
+
+# Per worker process, set up once by init_worker: the accounts parsed by the parent and
+# the sessions shared by every account the worker runs.
+# Downloaded source data is not shared, each account fetches with its own credentials,
+# branch IDs and sheet URLs
+_accounts = None
+_shared_sessions = {}
+
+def init_worker(accounts, buckets):
+    global _accounts
+    _accounts = accounts
+    # Workers draw from the same per-host buckets, so an account alone on a host gets its full limits
+    rate_limiter.use_shared_buckets(buckets)
+
+def account_sessions(account):
+    # Sources without a login share one connection pool per worker across accounts,
+    # logged-in sessions belong to a single account and are opened by each run
+    sessions = {}
+    for name in account.sources:
+        if name not in main.SOURCE_LOGINS:
+            sessions[name] = _shared_sessions.setdefault(name, requests.Session())
+    return sessions
+
+def run_account(name):
+    """Run one account's pipeline in its own output directory, returns its report entry."""
+    account = _accounts[name]
+    output_dir = account.output_dir
+    os.makedirs(account.data_dir, exist_ok=True)
+    log_handler = logging.FileHandler(os.path.join(output_dir, 'run.log'), encoding='utf-8')
+    log_handler.setFormatter(logging.Formatter(f'%(asctime)s - %(levelname)s - [{name}] %(message)s', '%Y-%m-%d %H:%M:%S'))
+    logging.getLogger().addHandler(log_handler)
+
+    report = {"account": name, "output_dir": output_dir, "pid": os.getpid()}
+    start = time.perf_counter()
+    try:
+        context = pipeline.run_pipeline(publish=False, sessions=account_sessions(account), account=account)
+        report.update({
+            "status": "ok",
+            "records": len(context["inventory"]),
+            "stale": context["stale"],
+            "produced": context["produced"],
+            "timings": context["timings"],
+        })
+    except Exception as e:
+        logging.error(f"Account {name} failed: {e}")
+        report.update({"status": "failed", "error": str(e), "traceback": traceback.format_exc()})
+    finally:
+        report["seconds"] = time.perf_counter() - start
+        logging.getLogger().removeHandler(log_handler)
+        log_handler.close()
+    return report
+
+def run_batch(config_dir, output_root, workers=None):
+    """Run every account in a process pool and write the aggregated report, returns it."""
+    output_root = os.path.abspath(output_root)
+    accounts = load_accounts(config_dir, output_root)
+    os.makedirs(output_root, exist_ok=True)
+    workers = min(workers or os.cpu_count(), len(accounts))
+    logging.info(f"Running {len(accounts)} accounts with {workers} workers")
+
+    started_at = datetime.now(main.bangkok_tz)
+    start = time.perf_counter()
+    reports = []
+    with multiprocessing.Manager() as manager:
+        buckets = rate_limiter.SharedBuckets(manager)
+        with ProcessPoolExecutor(max_workers=workers, initializer=init_worker, initargs=(accounts, buckets)) as executor:
+            futures = {executor.submit(run_account, name): name for name in accounts}
+            for future in as_completed(futures):
+                try:
+                    report = future.result()
+                except Exception as e:
+                    # The worker process itself died
+                    report = {"account": futures[future], "status": "failed", "error": str(e)}
+                logging.info(f"Account {report['account']} {report['status']} in {report.get('seconds', 0):.2f}s")
+                reports.append(report)
+
+    reports.sort(key=lambda report: report["account"])
+    wall_seconds = time.perf_counter() - start
+    account_seconds = [report.get("seconds", 0) for report in reports]
+    summary = {
+        "started_at": started_at.strftime("%Y-%m-%d %H:%M:%S"),
+        "workers": workers,
+        "accounts": len(reports),
+        "succeeded": sum(report["status"] == "ok" for report in reports),
+        "failed": [report["account"] for report in reports if report["status"] != "ok"],
+        "stale": {report["account"]: report["stale"] for report in reports if report.get("stale")},
+        "wall_seconds": wall_seconds,
+        "slowest_account_seconds": max(account_seconds),
+        "sequential_seconds": sum(account_seconds),
+        "results": reports,
+    }
+    report_path = os.path.join(output_root, REPORT_FILENAME)
+    with open(report_path, 'w', encoding='utf-8') as file:
+        json.dump(summary, file, ensure_ascii=False, indent=2)
+
+    logging.info(f"Batch finished in {wall_seconds:.2f}s ({summary['sequential_seconds']:.2f}s of account runs), "
+                 f"{summary['succeeded']}/{summary['accounts']} accounts succeeded, report written to {report_path}")
+    return summary
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run the inventory pipeline for every account config in a directory")
+    parser.add_argument('config_dir', help="directory of <account>.json configs")
+    parser.add_argument('--output', default='accounts_output', help="each account writes to <output>/<account>/")
+    parser.add_argument('--workers', type=int, default=None, help="worker processes (default: CPU count)")
+    args = parser.parse_args()
+
+    summary = run_batch(args.config_dir, args.output, args.workers)
+    if summary["failed"]:
+        raise SystemExit(1)
@@ -8,7 +8,7 @@ def generate_file_list(data_directory='./data'):
 
     # Iterate over files in the specified directory
     for filename in os.listdir(data_directory):
-        if filename.endswith('.json') and filename != 'file_list.json':
+        if filename.endswith('.json') and filename != 'file_list.json' and not filename.endswith('.index.json'):
             json_files.append(filename)
 
     # Sort the json_files by date and time extracted from the filename
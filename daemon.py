@@ -0,0 +1,158 @@
+import hashlib
+import json
+import logging
+import time
+
+import requests
+
+import deadline
+import main
+from git_push import commit_and_push
+
+# Refresh interval per source, in seconds
+REFRESH_INTERVALS = {
+    "chococard": 30 * 60,
+    "zort": 10 * 60,
+    "vending": 30 * 60,
+    "hq": 60 * 60,
+    "saimai": 60 * 60,
+}
+
+# Delay before retrying a source whose download failed, in seconds
+FAILURE_RETRY_DELAY = 60
+
+# Time budget for one source refresh, in seconds
+REFRESH_DEADLINE = 5 * 60
+
+# Minimum time between timestamped data/ snapshots, in seconds.
+# Changes in between only update inventory_data.json and the search index
+SNAPSHOT_INTERVAL = 60 * 60
+
+def digest(data):
+    return hashlib.sha1(json.dumps(data, sort_keys=True, ensure_ascii=False, default=str).encode('utf-8')).hexdigest()
+
+class InventoryDaemon:
+    """
+    Keeps sessions, per-source results and the merged inventory in memory and refreshes
+    each source on its own interval. A new snapshot is published only when the merged
+    inventory actually changed.
+    """
+
+    def __init__(self, intervals=None, snapshot_interval=SNAPSHOT_INTERVAL, push=True):
+        self.intervals = dict(intervals or REFRESH_INTERVALS)
+        self.snapshot_interval = snapshot_interval
+        self.push = push
+        self.last_snapshot = None
+        self.publish_failed = False
+        self.sessions = {}
+        self.results = {}
+        self.digests = {}
+        self.next_due = {name: 0 for name in main.SOURCES}
+        self.inventory = None
+        self.inventory_digest = None
+
+    def get_session(self, name):
+        if self.sessions.get(name) is None:
+            # Sources with a login keep their authenticated session, other sources just reuse connections
+            session = main.SOURCE_LOGINS.get(name, requests.Session)()
+            if session is None:
+                # Skip this refresh instead of downloading without a login
+                raise RuntimeError(f"Login to {name} failed")
+            self.sessions[name] = session
+        return self.sessions[name]
+
+    def refresh_source(self, name):
+        """Download one source, returns True when its data changed."""
+        download, _ = main.SOURCES[name]
+        deadline.start(REFRESH_DEADLINE)
+        try:
+            result = download(self.get_session(name))
+        except Exception as e:
+            logging.error(f"Refreshing {name} failed: {e}")
+            result = None
+        finally:
+            deadline.start(None)
+
+        if name == "chococard" and result is not None and len(result) < len(main.CHOCOCARD_BRANCHES):
+            # Missing branches usually mean the login expired; keep the last good rows
+            # for those branches and log in again on the next refresh
+            self.sessions.pop(name, None)
+            previous = self.results.get(name) or main.load_last_good(name) or {}
+            result = {**{b: rows for b, rows in previous.items() if b not in result}, **result}
+
+        if result is None:
+            self.sessions.pop(name, None)
+            self.next_due[name] = time.monotonic() + min(FAILURE_RETRY_DELAY, self.intervals[name])
+            if name in self.results:
+                return False
+            # Nothing in memory yet (first refresh after a start), use the last good result
+            result = main.load_last_good(name)
+            if result is None:
+                return False
+            logging.warning(f"Using stale {name} data from the last good result")
+        else:
+            self.next_due[name] = time.monotonic() + self.intervals[name]
+            main.save_last_good(name, result)
+
+        result_digest = digest(result)
+        if result_digest == self.digests.get(name):
+            logging.info(f"No changes in {name} data")
+            return False
+
+        self.results[name] = result
+        self.digests[name] = result_digest
+        logging.info(f"{name} data changed")
+        return True
+
+    def run_once(self):
+        """Refresh every due source and publish if the merged inventory changed."""
+        now = time.monotonic()
+        changed = False
+        for name in main.SOURCES:
+            if self.next_due[name] <= now:
+                changed = self.refresh_source(name) or changed
+
+        # Wait until every required source has reported at least once before the first publish
+        if not (changed or self.publish_failed) or any(name not in self.results for name in main.SOURCES if name not in main.OPTIONAL_SOURCES):
+            return False
+
+        inventory = main.merge_inventory(self.results)
+        inventory_digest = digest(inventory)
+        if inventory_digest == self.inventory_digest:
+            logging.info("Merged inventory unchanged, skipping publish")
+            return False
+
+        self.inventory = inventory
+        # Only remember the digest once published, so a failed export or push is retried
+        self.publish_failed = True
+        self.publish(inventory)
+        self.publish_failed = False
+        self.inventory_digest = inventory_digest
+        return True
+
+    def publish(self, inventory):
+        """Export the inventory and push the files this publish wrote, raises when the push fails."""
+        now = time.monotonic()
+        snapshot = self.last_snapshot is None or now - self.last_snapshot >= self.snapshot_interval
+        produced = main.export_inventory(inventory, snapshot=snapshot)
+        if snapshot:
+            self.last_snapshot = now
+            produced.append(main.generate_file_list())
+        if self.push:
+            commit_and_push(produced)
+
+    def run_forever(self):
+        logging.info("Starting inventory daemon")
+        while True:
+            try:
+                self.run_once()
+            except Exception as e:
+                # Keep running, a failed publish is retried after FAILURE_RETRY_DELAY
+                logging.exception(f"Daemon iteration failed: {e}")
+            next_run = min(self.next_due.values())
+            if self.publish_failed:
+                next_run = min(next_run, time.monotonic() + FAILURE_RETRY_DELAY)
+            time.sleep(max(1, next_run - time.monotonic()))
+
+if __name__ == "__main__":
+    InventoryDaemon().run_forever()
@@ -0,0 +1,47 @@
+import time
+
+import requests
+
+# Per-request timeouts used when no run deadline is set, or when it leaves more room
+DEFAULT_CONNECT_TIMEOUT = 10
+DEFAULT_READ_TIMEOUT = 60
+
+# Requests are not started with less than this many seconds left
+MIN_REQUEST_BUDGET = 1.0
+
+_deadline = None
+
+class DeadlineExceeded(requests.exceptions.Timeout):
+    """The run deadline passed before the request could be made."""
+
+def start(seconds):
+    """Set the run deadline `seconds` from now, None clears it."""
+    global _deadline
+    _deadline = None if seconds is None else time.monotonic() + seconds
+
+def remaining():
+    """Seconds left in the run, or None without a deadline."""
+    if _deadline is None:
+        return None
+    return max(0.0, _deadline - time.monotonic())
+
+def expired():
+    left = remaining()
+    return left is not None and left < MIN_REQUEST_BUDGET
+
+def check():
+    if expired():
+        raise DeadlineExceeded("Run deadline exceeded")
+
+def request_timeout(connect=DEFAULT_CONNECT_TIMEOUT, read=DEFAULT_READ_TIMEOUT):
+    """(connect, read) timeouts for requests, capped by the time left in the run."""
+    left = remaining()
+    if left is None:
+        return connect, read
+    check()
+    return min(connect, left), min(read, left)
+
+def sleep(seconds):
+    """time.sleep that never sleeps past the deadline."""
+    left = remaining()
+    time.sleep(seconds if left is None else min(seconds, left))
@@ -2,26 +2,63 @@ import os
 import subprocess
 from datetime import datetime
 
-def git_push_with_timestamp():
+# Pushes rejected as non-fast-forward are rebased on origin/main and retried this many times
+PUSH_ATTEMPTS = 3
+
+def push_with_rebase(attempts=PUSH_ATTEMPTS):
+    """Push to origin/main, rebasing on it when the push is rejected. Raises CalledProcessError on failure."""
+    for attempt in range(1, attempts + 1):
+        if subprocess.run(['git', 'push', '--set-upstream', 'origin', 'main']).returncode == 0:
+            return
+        if attempt == attempts:
+            break
+        # Usually another publisher (the nightly workflow) pushed first
+        print("Push rejected, rebasing on origin/main and retrying")
+        rebase = subprocess.run(['git', 'pull', '--rebase', '--autostash', 'origin', 'main'])
+        if rebase.returncode != 0:
+            subprocess.run(['git', 'rebase', '--abort'])
+            break
+    raise subprocess.CalledProcessError(1, 'git push')
+
+def commit_and_push(paths=None):
+    """
+    Commit and push like git_push_with_timestamp, but raise on errors.
+    Returns True when pushed and False when none of the given paths changed.
+    """
+    now = datetime.now()
+    commit_message = now.strftime("Update on %Y-%m-%d at %H:%M:%S")
+
+    if paths:
+        status = subprocess.run(['git', 'status', '--porcelain', '--', *paths], check=True, capture_output=True, text=True)
+        if not status.stdout.strip():
+            print("No changes to push")
+            return False
+        subprocess.run(['git', 'add', '--', *paths], check=True)
+        # Commit only these paths, anything else already staged stays out of the commit
+        subprocess.run(['git', 'commit', '-m', commit_message, '--', *paths], check=True)
+    else:
+        subprocess.run(['git', 'add', '.'], check=True)
+        subprocess.run(['git', 'commit', '-m', commit_message], check=True)
+    push_with_rebase()
+
+    print(f"Successfully pushed with commit: '{commit_message}'")
+    return True
+
+def git_push_with_timestamp(paths=None):
     """
     Push changes to the Git repository with a commit message that includes the current date and time.
     Sets upstream if it's the first push to the specified branch.
+    When paths are given only those files are staged, and nothing is committed if none of them changed.
     """
     # Use the current working directory
     repo_path = os.getcwd()
     os.chdir(repo_path)
-    
-    now = datetime.now()
-    commit_message = now.strftime("Update on %Y-%m-%d at %H:%M:%S")
-    
+
     try:
-        subprocess.run(['git', 'add', '.'], check=True)
-        subprocess.run(['git', 'commit', '-m', commit_message], check=True)
-        subprocess.run(['git', 'push', '--set-upstream', 'origin', 'main'], check=True)
-        
-        print(f"Successfully pushed with commit: '{commit_message}'")
-    except subprocess.CalledProcessError as e:
+        return commit_and_push(paths)
+    except (subprocess.CalledProcessError, OSError) as e:
         print(f"An error occurred: {e}")
+        return False
 
 if __name__ == "__main__":
     git_push_with_timestamp()  # Call the function directly
\ No newline at end of file
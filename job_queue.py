@@ -0,0 +1,318 @@
+import argparse
+import json
+import logging
+import math
+import multiprocessing
+import os
+import socket
+import sqlite3
+import time
+import uuid
+
+import requests
+
+import deadline
+import main
+import rate_limiter
+
+# A leased job that is not completed within this many seconds is handed to another worker
+LEASE_SECONDS = 300
+
+# Every job runs under its own deadline, kept below the lease so its retries and request
+# timeouts end before another worker can claim the job
+JOB_DEADLINE = LEASE_SECONDS - 60
+MAX_ATTEMPTS = 3
+RETRY_DELAY = 10
+POLL_INTERVAL = 1.0
+
+# Local workers started by the coordinator. Every worker has its own rate limiter, so the
+# per-host limits are divided between them (see rate_limiter.share_limits)
+DEFAULT_WORKERS = 2
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY,
+    run_id TEXT NOT NULL,
+    source TEXT NOT NULL,
+    unit TEXT NOT NULL,
+    status TEXT NOT NULL DEFAULT 'pending',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    available_at REAL NOT NULL DEFAULT 0,
+    lease_owner TEXT,
+    lease_expires REAL,
+    result TEXT,
+    error TEXT,
+    UNIQUE (run_id, source, unit)
+);
+CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, available_at);
+"""
+
+class JobQueue:
+    """
+    SQLite-backed job queue with leases. Workers in other processes, or on other hosts
+    sharing the database file, claim jobs with a write transaction so each job has one owner.
+    A job whose lease expires (crashed worker) is claimed again until MAX_ATTEMPTS is reached.
+    The default rollback journal is used because WAL does not work on network file systems.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.connection = sqlite3.connect(path, timeout=60, isolation_level=None)
+        self.connection.executescript(SCHEMA)
+
+    def close(self):
+        self.connection.close()
+
+    def _write(self, statements):
+        # BEGIN IMMEDIATE takes the write lock up front so concurrent claims never interleave
+        cursor = self.connection.cursor()
+        cursor.execute("BEGIN IMMEDIATE")
+        try:
+            result = statements(cursor)
+            cursor.execute("COMMIT")
+            return result
+        except BaseException:
+            cursor.execute("ROLLBACK")
+            raise
+
+    def enqueue(self, run_id, jobs, cursor=None):
+        rows = [(run_id, source, json.dumps(unit, sort_keys=True)) for source, unit in jobs]
+        insert = "INSERT OR IGNORE INTO jobs (run_id, source, unit) VALUES (?, ?, ?)"
+        if cursor is not None:
+            cursor.executemany(insert, rows)
+        else:
+            self._write(lambda cursor: cursor.executemany(insert, rows))
+
+    def claim(self, owner):
+        """Lease the next available job, returns (id, run_id, source, unit) or None."""
+        def statements(cursor):
+            now = time.time()
+            # Expired leases that used up their attempts are failed instead of retried
+            cursor.execute(
+                "UPDATE jobs SET status = 'failed', error = COALESCE(error, 'lease expired') "
+                "WHERE status = 'leased' AND lease_expires < ? AND attempts >= ?", (now, MAX_ATTEMPTS))
+            job = cursor.execute(
+                "SELECT id, run_id, source, unit FROM jobs "
+                "WHERE (status = 'pending' AND available_at <= ?) OR (status = 'leased' AND lease_expires < ?) "
+                "ORDER BY id LIMIT 1", (now, now)).fetchone()
+            if job is None:
+                return None
+            cursor.execute(
+                "UPDATE jobs SET status = 'leased', attempts = attempts + 1, lease_owner = ?, lease_expires = ? WHERE id = ?",
+                (owner, now + LEASE_SECONDS, job[0]))
+            return job[0], job[1], job[2], json.loads(job[3])
+        return self._write(statements)
+
+    def complete(self, job_id, owner, result, follow_up=None):
+        """Store a job's result, and enqueue follow-up jobs of the same run in the same transaction."""
+        def statements(cursor):
+            cursor.execute(
+                "UPDATE jobs SET status = 'done', result = ?, error = NULL WHERE id = ? AND lease_owner = ? AND status = 'leased'",
+                (json.dumps(result, ensure_ascii=False), job_id, owner))
+            if cursor.rowcount and follow_up:
+                run_id = cursor.execute("SELECT run_id FROM jobs WHERE id = ?", (job_id,)).fetchone()[0]
+                self.enqueue(run_id, follow_up, cursor)
+        self._write(statements)
+
+    def fail(self, job_id, owner, error):
+        def statements(cursor):
+            cursor.execute(
+                "UPDATE jobs SET status = CASE WHEN attempts >= ? THEN 'failed' ELSE 'pending' END, "
+                "error = ?, available_at = ?, lease_owner = NULL "
+                "WHERE id = ? AND lease_owner = ? AND status = 'leased'",
+                (MAX_ATTEMPTS, str(error), time.time() + RETRY_DELAY, job_id, owner))
+        self._write(statements)
+
+    def has_work(self, run_id=None):
+        query = "SELECT COUNT(*) FROM jobs WHERE status IN ('pending', 'leased')"
+        params = ()
+        if run_id is not None:
+            query += " AND run_id = ?"
+            params = (run_id,)
+        return self.connection.execute(query, params).fetchone()[0] > 0
+
+    def results(self, run_id):
+        """Return [(source, unit, status, result)] for every job of a run."""
+        rows = self.connection.execute(
+            "SELECT source, unit, status, result FROM jobs WHERE run_id = ? ORDER BY id", (run_id,)).fetchall()
+        return [(source, json.loads(unit), status, json.loads(result) if result else None)
+                for source, unit, status, result in rows]
+
+# One job per source unit: each ChocoCard branch, each ZORT page, each vending batch, each sheet
+def plan_jobs():
+    jobs = [("chococard", {"branch": branch}) for branch in main.CHOCOCARD_BRANCHES]
+    jobs.append(("zort", {"page": 1}))
+    machines = main.vend_machines
+    for start in range(0, len(machines), main.VEND_BATCH_SIZE):
+        jobs.append(("vending", {"machines": machines[start:start + main.VEND_BATCH_SIZE]}))
+    jobs.append(("hq", {}))
+    jobs.append(("saimai", {}))
+    return jobs
+
+class Worker:
+    """Fetches and normalizes claimed jobs, keeping one session per source for its lifetime."""
+
+    def __init__(self, queue):
+        self.queue = queue
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self.sessions = {}
+
+    def session(self, source):
+        if self.sessions.get(source) is None:
+            session = main.SOURCE_LOGINS.get(source, requests.Session)()
+            if session is None:
+                # Fail the job rather than fetching without a login, the next attempt logs in again
+                raise RuntimeError(f"Login to {source} failed")
+            self.sessions[source] = session
+        return self.sessions[source]
+
+    def run_job(self, source, unit):
+        """Returns (result, follow-up jobs), raises when the unit could not be fetched."""
+        follow_up = []
+        if source == "chococard":
+            result = main.download_chococard_branch(self.session(source), unit["branch"])
+        elif source == "zort":
+            page = main.download_zort_page(unit["page"], self.session(source))
+            result = None
+            if page is not None:
+                result, count = page
+                # The first page tells how many pages there are
+                if unit["page"] == 1:
+                    pages = math.ceil(count / main.ZORT_PAGE_SIZE)
+                    follow_up = [("zort", {"page": number}) for number in range(2, pages + 1)]
+        elif source == "vending":
+            result = main.download_vending_batch(self.session(source), unit["machines"])
+        else:
+            download, _ = main.SOURCES[source]
+            result = download(self.session(source))
+
+        if result is None:
+            # Drop the session in case the login expired
+            self.sessions.pop(source, None)
+            raise RuntimeError(f"No data received from {source} {unit}")
+        return result, follow_up
+
+    def run(self, drain=False):
+        """Process jobs until stopped, or until no work is left when `drain` is set."""
+        logging.info(f"Worker {self.owner} started")
+        while True:
+            job = self.queue.claim(self.owner)
+            if job is None:
+                if drain and not self.queue.has_work():
+                    break
+                time.sleep(POLL_INTERVAL)
+                continue
+
+            job_id, run_id, source, unit = job
+            logging.info(f"Running {source} {unit} for run {run_id}")
+            deadline.start(JOB_DEADLINE)
+            try:
+                result, follow_up = self.run_job(source, unit)
+            except Exception as e:
+                logging.error(f"Job {source} {unit} failed: {e}")
+                self.queue.fail(job_id, self.owner, e)
+            else:
+                self.queue.complete(job_id, self.owner, result, follow_up)
+            finally:
+                deadline.start(None)
+        logging.info(f"Worker {self.owner} finished")
+
+def run_worker(db_path, drain=False, processes=1):
+    """Run one worker, `processes` is the number of workers fetching at the same time."""
+    rate_limiter.share_limits(processes)
+    queue = JobQueue(db_path)
+    try:
+        Worker(queue).run(drain)
+    finally:
+        queue.close()
+
+def collect_results(queue, run_id):
+    """
+    Rebuild main.SOURCES-style results from a finished run, returns (results, stale sources).
+    Failed sources and ChocoCard branches are filled from their last good result.
+    """
+    done = {}
+    failed = set()
+    for source, unit, status, result in queue.results(run_id):
+        if status == "done":
+            done.setdefault(source, []).append((unit, result))
+        else:
+            failed.add(source)
+
+    source_results = {}
+    stale = []
+    for source in main.SOURCES:
+        units = done.get(source, [])
+        if source == "chococard":
+            # Missing branches are tolerated, as in download_chococard_data()
+            source_results[source] = {unit["branch"]: rows for unit, rows in units}
+        elif source == "vending":
+            # Vending batches are independent, keep the ones that succeeded
+            source_results[source] = [row for _, rows in units for row in rows] if units or source not in failed else None
+        elif source in failed or not units:
+            source_results[source] = None
+        else:
+            # ZORT pages are concatenated in page order
+            units.sort(key=lambda unit_result: unit_result[0].get("page", 0))
+            source_results[source] = [row for _, rows in units for row in rows]
+
+        source_results[source] = main.fill_from_last_good(source, source_results[source], stale)
+        if source_results[source] is None:
+            if source not in main.OPTIONAL_SOURCES:
+                raise RuntimeError(f"No data received from {source}")
+            logging.error(f"No data received from {source}, continuing without it")
+
+    if stale:
+        logging.warning(f"Stale data filled from the last good results: {', '.join(stale)}")
+    return source_results, stale
+
+def run_coordinator(db_path, workers=DEFAULT_WORKERS, timeout=3600):
+    """Enqueue one run, optionally start local workers, wait for it and export the merged inventory."""
+    run_id = f"{time.strftime('%Y%m%d%H%M%S')}-{uuid.uuid4().hex[:8]}"
+    queue = JobQueue(db_path)
+    processes = []
+    try:
+        jobs = plan_jobs()
+        queue.enqueue(run_id, jobs)
+        logging.info(f"Enqueued {len(jobs)} jobs for run {run_id}")
+
+        processes = [multiprocessing.Process(target=run_worker, args=(db_path, True, workers)) for _ in range(workers)]
+        for process in processes:
+            process.start()
+
+        wait_until = time.monotonic() + timeout
+        while queue.has_work(run_id):
+            if time.monotonic() > wait_until:
+                raise TimeoutError(f"Run {run_id} did not finish within {timeout}s")
+            time.sleep(POLL_INTERVAL)
+
+        for process in processes:
+            process.join()
+
+        source_results, _ = collect_results(queue, run_id)
+    finally:
+        # Local workers are stopped when the run fails or times out
+        for process in processes:
+            if process.is_alive():
+                process.terminate()
+            process.join()
+        queue.close()
+
+    main.export_inventory(main.merge_inventory(source_results))
+    main.generate_file_list()
+    return run_id
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Fetch inventory sources through a SQLite job queue")
+    parser.add_argument('role', choices=['coordinator', 'worker'])
+    parser.add_argument('--db', default='jobs.sqlite', help="queue database, shared by every worker")
+    parser.add_argument('--workers', type=int, default=DEFAULT_WORKERS, help="local workers started by the coordinator")
+    parser.add_argument('--processes', type=int, default=1, help="workers fetching at the same time across hosts, they share the per-host limits")
+    parser.add_argument('--drain', action='store_true', help="worker exits when the queue is empty")
+    parser.add_argument('--timeout', type=int, default=3600, help="seconds the coordinator waits for its run")
+    args = parser.parse_args()
+
+    if args.role == 'coordinator':
+        run_coordinator(args.db, args.workers, args.timeout)
+    else:
+        run_worker(args.db, args.drain, args.processes)
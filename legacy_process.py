@@ -1,30 +1,20 @@
-import subprocess
 import logging
 
+from pipeline import run_pipeline
+
 # Set up logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
-def run_script(script_name):
-    try:
-        subprocess.run(['python', script_name], check=True)
-        logging.info(f"Successfully executed {script_name}")
-    except subprocess.CalledProcessError as e:
-        logging.error(f"Error executing {script_name}: {e}")
-        raise
-
 def main():
     try:
         logging.info("Starting the data processing pipeline")
-        
-        # Run main_download.py
-        run_script('main.py')
-        
-        # Run git_push.py
-        run_script('git_push.py')
-        
+
+        # Fetch, export and push in this process instead of spawning main.py and git_push.py
+        run_pipeline()
+
         logging.info("Data processing pipeline completed successfully")
     except Exception as e:
         logging.error(f"An error occurred in the data processing pipeline: {e}")
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
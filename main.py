@@ -1,16 +1,23 @@
 import pandas as pd
 import os
+import argparse
+from contextlib import nullcontext
 from datetime import datetime
 from dotenv import load_dotenv
-import time
+from concurrent.futures import ThreadPoolExecutor
 import requests
 import json
+import shutil
 import logging
 import warnings
 from io import BytesIO
 from bs4 import BeautifulSoup
 import pytz  # Import pytz for timezone handling
 
+import deadline
+import rate_limiter
+from search_index import INDEX_SUFFIX, write_search_index
+
 warnings.simplefilter("ignore", UserWarning)
 
 # Set timezone to Asia/Bangkok
@@ -30,6 +37,21 @@ zort_storename = os.getenv('STORENAME')
 zort_apikey = os.getenv('APIKEY')
 zort_apisecret = os.getenv('APISECRET')
 
+# Vending machine IDs to export, comma separated
+vend_machines = [machine.strip() for machine in os.getenv('VEND_MACHINES', 'VCM350CKC20090003,VCM350CKC20120001').split(',') if machine.strip()]
+
+# Write snapshots in the canonical, git-friendly layout (see canonical_inventory)
+canonical_export = os.getenv('CANONICAL_EXPORT', '').lower() in ('1', 'true', 'yes')
+
+# Time budget for a whole run in seconds, every request timeout is derived from what is left
+run_deadline = float(os.getenv('RUN_DEADLINE', 1200))
+
+# Last good result of every source, used when a source fails or misses the deadline
+SOURCE_CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'cache')
+
+# Timestamped snapshots listed by data/file_list.json
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data')
+
 # Retry decorator
 def retry(max_retries=5, delay=2):
     def decorator(func):
@@ -40,23 +62,94 @@ def retry(max_retries=5, delay=2):
                     return func(*args, **kwargs)
                 except Exception as e:
                     retries += 1
+                    if deadline.expired():
+                        logging.error(f"Attempt {retries} failed: {e}. Run deadline reached, giving up.")
+                        return None
                     logging.warning(f"Attempt {retries} failed: {e}. Retrying...")
-                    time.sleep(delay)
+                    deadline.sleep(delay)
             logging.error(f"Failed after {max_retries} attempts.")
             return None
         return wrapper
     return decorator
 
-# Download and process data from ChocoCard with retry logic for each branch
-def download_chococard_data():
-    logging.info("Starting ChocoCard data download...")
-    
+# ChocoCard branches: branch name -> (restaurant id, template id)
+CHOCOCARD_BRANCHES = {
+    "Samyan": (7485, 2209),
+    "Circle": (7487, 2207),
+    "Rama 9": (7484, 2206),
+    "Eastville": (7483, 2205),
+    "Mega": (7482, 2204),
+    "Embassy": (7481, 2203),
+    "EmQuartier": (7480, 2202),
+    "Gaysorn Centre": (7486, 2208)
+}
+
+HQ_SHEET_URL = "https://docs.google.com/spreadsheets/d/1jGJw7N9fYjFZtVtvGQc7dyeCdjQRXNzr/export?format=csv&gid=1922842361"
+SAIMAI_SHEET_URL = "https://docs.google.com/spreadsheets/d/1E5RCU9ZwZurC0KhQ49YangnLDiE0qInP5EPusIxyTsI/export?format=csv&gid=1646174814"
+
+# Saimai SKU -> inventory SKU mapping
+SAIMAI_SKU_MAPPING = {
+    "EW-VSD": "P_EW-US",
+    "EW-VD": "P_EW-INT",
+    "EW-ORTHO": "P_EW-PO",
+    "EW-WJ180": "PEW-WJ180",
+    "EW-GUM75": "P_EW-GUM75",
+    "EW-TW75": "P_EW-TW75",
+    "EW-PL70": "P_EW-FT70",
+    "EW-SG2A": "P_EW-Refill-DC",
+    "EW-SG2B": "P_EW-Refill-TF",
+    "EW-SG2W": "P_EW-Refill-WH",
+    "EW-VW": "P_EW-SE",
+    "EW-XF50": "P_EW-SF",
+    "EW-SG8": "P_EW-SG8",
+    "EW-GUM12": "P_F_EW_CRF12",
+    "EW-TW12": "P_F_EW_WHT12",
+    "EW-VSD2": "PEW-US-Duo",
+    "EW-SG8+": "EW-SG8PLUS",
+    "EW-PC70": "P_EW-FTGR",
+    "EW-SR75": "P_EW-SR75",
+    "EW-SR12": "P_F_EW_STS12",
+}
+
+# Add (item, sku, qty) rows for one branch, keyed by item name
+def apply_branch_rows(reorganized_inventory, branch, rows):
+    for item, sku, qty in rows:
+        if item not in reorganized_inventory:
+            reorganized_inventory[item] = {
+                "SKU": sku,
+                "Branch": dict()  # เปลี่ยนจาก OrderedDict() เป็น dict()
+            }
+        reorganized_inventory[item]["Branch"][branch] = qty
+
+# Add (branch, sku, qty) rows matched against existing items by SKU
+def upsert_sku_rows(reorganized_inventory, rows):
+    # Index the first item key of every SKU once instead of scanning the inventory per row
+    sku_index = {}
+    for item_key, details in reorganized_inventory.items():
+        sku_index.setdefault(details["SKU"], item_key)
+
+    for branch, sku, qty in rows:
+        item_key = sku_index.get(sku)
+        if item_key is not None:
+            reorganized_inventory[item_key]["Branch"][branch] = qty
+
+        # If SKU not found, create new entry keyed by the SKU
+        elif sku not in reorganized_inventory:
+            reorganized_inventory[sku] = {
+                "SKU": sku,
+                "Branch": {branch: qty}
+            }
+            sku_index[sku] = sku
+
+# Log in to ChocoCard and return the authenticated session
+def chococard_login(account=None):
+    account = account or Account()
     # Create a session to store cookies
     session = requests.Session()
     
     # Fetch the login page
     login_url = "https://mychococard.com/Account/Login"
-    response = session.get(login_url)
+    response = rate_limiter.request(session, 'GET', login_url)
 
     # Use BeautifulSoup to parse HTML and find the token
     soup = BeautifulSoup(response.text, 'html.parser')
@@ -64,247 +157,369 @@ def download_chococard_data():
     
     # Create login data
     login_data = {
-        'username': choco_username,
-        'password': choco_password,
+        'username': account.choco_username,
+        'password': account.choco_password,
         '__RequestVerificationToken': token
     }
 
     # Perform login
-    response = session.post(login_url, data=login_data)
+    response = rate_limiter.request(session, 'POST', login_url, data=login_data)
     
     # Check if login was successful
     if response.status_code == 200:
         logging.info("Login successful!")
-        
-        time.sleep(1)
-
-        # Base URL for downloading inventory data for each branch
-        base_url = "https://mychococard.com/CRM/v2/Restaurant/{}/Inventory/DownloadTemplate/{}"
-        branches = {
-            "Samyan": (7485, 2209),
-            "Circle": (7487, 2207),
-            "Rama 9": (7484, 2206),
-            "Eastville": (7483, 2205),
-            "Mega": (7482, 2204),
-            "Embassy": (7481, 2203),
-            "EmQuartier": (7480, 2202),
-            "Gaysorn Centre": (7486, 2208)
-        }
+        return session
+    else:
+        logging.error(f"Login failed. Status code: {response.status_code}")
+        logging.info("Attempting to login again...")
+        return chococard_login(account)  # Try logging in again
 
-        # Prepare dictionary to store reorganized inventory data
-        reorganized_inventory = {}
+# Base URL for downloading inventory data for each branch
+CHOCOCARD_TEMPLATE_URL = "https://mychococard.com/CRM/v2/Restaurant/{}/Inventory/DownloadTemplate/{}"
 
-        # Download and process data for each branch
-        for branch_name, (id_, template_id) in branches.items():
-            success = False
-            retries = 0
-            max_retries = 5
-            delay = 5
+# Download one ChocoCard branch with retry logic, returns [(item, sku, qty), ...] or None
+def download_chococard_branch(session, branch_name, account=None):
+    id_, template_id = (account or Account()).chococard_branches[branch_name]
+    retries = 0
+    max_retries = 5
+    delay = 5
 
-            while not success and retries < max_retries:
-                try:
-                    url = base_url.format(id_, template_id)
-                    
-                    # Send GET request
-                    response = session.get(url)
-                    
-                    # Check response status
-                    if response.status_code == 200:
-                        excel_file = BytesIO(response.content)
-                        
-                        # Read Excel file
-                        df = pd.read_excel(excel_file, engine='openpyxl')
-                        df = df[['Item', 'SKU', 'Available Qty.']]  # Select necessary columns
-                        df.columns = ['Item', 'SKU', 'Qty']  # Rename columns
-
-                        # Reorganize data and add to inventory
-                        for _, row in df.iterrows():
-                            item = row['Item']
-                            sku = row['SKU']
-                            qty = int(row['Qty'])  # Convert quantity to integer
-
-                            if item not in reorganized_inventory:
-                                reorganized_inventory[item] = {
-                                    "SKU": sku,
-                                    "Branch": dict()  # เปลี่ยนจาก OrderedDict() เป็น dict()
-                                }
-                            reorganized_inventory[item]["Branch"][branch_name] = qty
-
-                        logging.info(f"Successfully processed data for branch {branch_name}")
-                        success = True  # Mark as successful to exit retry loop
-
-                    else:
-                        raise Exception(f"File download failed. Status: {response.status_code}")
+    while retries < max_retries:
+        try:
+            url = CHOCOCARD_TEMPLATE_URL.format(id_, template_id)
+            
+            # Send GET request, duplicated if the first one is slow
+            response = rate_limiter.hedged_request(session, 'GET', url)
+            
+            # Check response status
+            if response.status_code == 200:
+                excel_file = BytesIO(response.content)
+                
+                # Read Excel file
+                df = pd.read_excel(excel_file, engine='openpyxl')
+                df = df[['Item', 'SKU', 'Available Qty.']]  # Select necessary columns
+                df.columns = ['Item', 'SKU', 'Qty']  # Rename columns
+
+                rows = [
+                    (row['Item'], row['SKU'], int(row['Qty']))  # Convert quantity to integer
+                    for _, row in df.iterrows()
+                ]
+
+                logging.info(f"Successfully processed data for branch {branch_name}")
+                return rows
+
+            else:
+                raise Exception(f"File download failed. Status: {response.status_code}")
+
+        except Exception as e:
+            retries += 1
+            if deadline.expired():
+                logging.error(f"Attempt {retries} for branch {branch_name} failed: {e}. Run deadline reached.")
+                return None
+            logging.warning(f"Attempt {retries} for branch {branch_name} failed: {e}. Retrying in {delay} seconds...")
+            deadline.sleep(delay)
+
+    logging.error(f"Unable to download and process data for branch {branch_name} after {max_retries} attempts")
+    return None
+
+# Download data from ChocoCard for each branch
+# Returns {branch: [(item, sku, qty), ...]} for every branch that succeeded
+def download_chococard_data(session=None, account=None):
+    logging.info("Starting ChocoCard data download...")
+    account = account or Account()
 
-                except Exception as e:
-                    retries += 1
-                    logging.warning(f"Attempt {retries} for branch {branch_name} failed: {e}. Retrying in {delay} seconds...")
-                    time.sleep(delay)
+    if session is None:
+        session = chococard_login(account)
 
-            if not success:
-                logging.error(f"Unable to download and process data for branch {branch_name} after {max_retries} attempts")
+    branch_rows = {}
+    for branch_name in account.chococard_branches:
+        rows = download_chococard_branch(session, branch_name, account)
+        if rows is not None:
+            branch_rows[branch_name] = rows
 
-        logging.info("ChocoCard data processed for all branches")
-        return reorganized_inventory  # Return reorganized data
-    else:
-        logging.error(f"Login failed. Status code: {response.status_code}")
-        logging.info("Attempting to login again...")
-        return download_chococard_data()  # Try logging in again
+    logging.info("ChocoCard data processed for all branches")
+    return branch_rows
+
+def apply_chococard_data(reorganized_inventory, branch_rows):
+    for branch_name, rows in branch_rows.items():
+        apply_branch_rows(reorganized_inventory, branch_name, rows)
+
+# Products per page when the ZORT product list is fetched page by page
+ZORT_PAGE_SIZE = 500
 
-# Fetch data from the API
+# Fetch data from the API, the whole list or a single page
 @retry(max_retries=5, delay=5)
-def fetch_api_data():
+def fetch_api_data(session=None, page=None, account=None):
+    account = account or Account()
     api_url = "https://open-api.zortout.com/v4/Product/GetProducts"
     headers = {
-        "storename": zort_storename,
-        "apikey": zort_apikey,
-        "apisecret": zort_apisecret
+        "storename": account.zort_storename,
+        "apikey": account.zort_apikey,
+        "apisecret": account.zort_apisecret
     }
+    params = {"page": page, "limit": ZORT_PAGE_SIZE} if page is not None else None
 
     logging.info("Fetching data from ZORT API...")
-    response = requests.get(api_url, headers=headers)
+    response = rate_limiter.request(session, 'GET', api_url, headers=headers, params=params)
     response.raise_for_status()
     logging.info("ZORT API data fetched successfully.")
     return response.json()
 
+def zort_rows(api_data):
+    return [(product['sku'], float(product['availablestock'])) for product in api_data.get('list', [])]
+
+# Fetch ZORT stock as [(sku, qty), ...]
+def download_zort_data(session=None, account=None):
+    api_data = fetch_api_data(session, account=account)
+    if api_data is None:
+        return None
+    return zort_rows(api_data)
+
+# Fetch one page of ZORT stock, returns ([(sku, qty), ...], total product count) or None
+def download_zort_page(page, session=None, account=None):
+    api_data = fetch_api_data(session, page, account)
+    if api_data is None:
+        return None
+    return zort_rows(api_data), int(api_data.get('count', 0))
+
+def apply_zort_data(reorganized_inventory, rows):
+    upsert_sku_rows(reorganized_inventory, (('On Time', sku, qty) for sku, qty in rows))
+
+# Google Sheets layouts: positional columns for SKU, Item and Qty, and data rows to skip below the header
+SHEET_LAYOUTS = {
+    "HQ": {"url": HQ_SHEET_URL, "sku": 2, "item": 3, "qty": 7, "skip_rows": 2},  # Data starts at row 4
+    "Saimai": {"url": SAIMAI_SHEET_URL, "sku": 1, "item": 2, "qty": 6, "skip_rows": 0},
+}
+
+# Number of CSV rows parsed at a time while streaming a sheet
+SHEET_CHUNK_ROWS = 5000
+
+# Convert a quantity cell to int, non-numeric or empty values become 0
+def parse_qty(value):
+    try:
+        return int(float(value))
+    except (TypeError, ValueError, OverflowError):
+        return 0
+
 # Function for downloading Google Sheets as CSV
+# Streams the export and parses only the layout's columns, returns [(item, sku, qty), ...]
 @retry(max_retries=5, delay=5)
-def download_google_sheet(branch, sheet_url):
+def download_google_sheet(branch, session=None, account=None):
     logging.info(f"Downloading data from {branch}")
+    layout = (account or Account()).sheet_layouts[branch]
     
     try:
-        # Use requests to download CSV data
-        response = requests.get(sheet_url)
-        response.raise_for_status()  # Check for HTTP errors
-        
-        # Create DataFrame directly from CSV data
-        df = pd.read_csv(BytesIO(response.content))
+        # Use requests to stream CSV data
+        with rate_limiter.hedged_request(session, 'GET', layout["url"], stream=True) as response:
+            response.raise_for_status()  # Check for HTTP errors
+            response.raw.decode_content = True
+
+            chunks = pd.read_csv(
+                response.raw,
+                header=None,
+                skiprows=1 + layout["skip_rows"],  # Header row plus the layout's offset
+                usecols=[layout["sku"], layout["item"], layout["qty"]],
+                dtype={layout["sku"]: str, layout["item"]: str},
+                converters={layout["qty"]: parse_qty},
+                chunksize=SHEET_CHUNK_ROWS,
+            )
+            rows = []
+            for chunk in chunks:
+                rows.extend(zip(chunk[layout["item"]], chunk[layout["sku"]], chunk[layout["qty"]]))
         
         logging.info(f"Successfully downloaded {branch} data")
-        return df
+        return rows
     
     except requests.exceptions.RequestException as e:
         logging.error(f"Unable to download {branch} Google Sheets file. Reason: {e}")
         raise  # Propagate the error for the `retry` decorator to handle
 
-# Download and Process Data From HQ
-def process_hq_data(reorganized_inventory):
-    # Download data from Google Sheets
-    df = download_google_sheet("HQ","https://docs.google.com/spreadsheets/d/1jGJw7N9fYjFZtVtvGQc7dyeCdjQRXNzr/export?format=csv&gid=1922842361")
-
-    # We'll start reading data from row 4 and use columns C (SKU), D (Item), H (Qty)
-    df = df.iloc[2:, [2, 3, 7]]  # Select desired rows and columns
-    df.columns = ['SKU', 'Item', 'Qty']  # Rename columns
-
-    # Convert Qty to int, coercing errors to NaN
-    df['Qty'] = pd.to_numeric(df['Qty'], errors='coerce').fillna(0).astype(int)  # Handle non-numeric values
-
-    # Add data for "HQ" branch to `reorganized_inventory`
-    for _, row in df.iterrows():
-        item = row['Item']
-        sku = row['SKU']
-        qty = row['Qty']
-
-        # Check for NaN values before adding to reorganized_inventory
-        if pd.notna(item) and pd.notna(sku) and qty > 0:  # Ensure item and SKU are not NaN and qty is positive
-            if item not in reorganized_inventory:
-                reorganized_inventory[item] = {
-                    "SKU": sku,
-                    "Branch": dict()  # เปลี่ยนจาก OrderedDict() เป็น dict()
-                }
-            reorganized_inventory[item]["Branch"]['HQ'] = qty
+# Download Data From HQ as [(item, sku, qty), ...]
+def download_hq_data(session=None, account=None):
+    rows = download_google_sheet("HQ", session, account)
+    if rows is None:
+        return None
 
+    # Ensure item and SKU are not NaN and qty is positive
+    return [(item, sku, qty) for item, sku, qty in rows if pd.notna(item) and pd.notna(sku) and qty > 0]
+
+def apply_hq_data(reorganized_inventory, rows):
+    apply_branch_rows(reorganized_inventory, 'HQ', rows)
     logging.info("Processed HQ data and added to inventory")
 
-# Download and Process Data From Saimai
-def process_saimai_data(reorganized_inventory):
-    # SKU mapping dictionary
-    sku_mapping = {
-        "EW-VSD": "P_EW-US",
-        "EW-VD": "P_EW-INT",
-        "EW-ORTHO": "P_EW-PO",
-        "EW-WJ180": "PEW-WJ180",
-        "EW-GUM75": "P_EW-GUM75",
-        "EW-TW75": "P_EW-TW75",
-        "EW-PL70": "P_EW-FT70",
-        "EW-SG2A": "P_EW-Refill-DC",
-        "EW-SG2B": "P_EW-Refill-TF",
-        "EW-SG2W": "P_EW-Refill-WH",
-        "EW-VW": "P_EW-SE",
-        "EW-XF50": "P_EW-SF",
-        "EW-SG8": "P_EW-SG8",
-        "EW-GUM12": "P_F_EW_CRF12",
-        "EW-TW12": "P_F_EW_WHT12",
-        "EW-VSD2": "PEW-US-Duo",
-        "EW-SG8+": "EW-SG8PLUS",
-        "EW-PC70": "P_EW-FTGR",
-        "EW-SR75": "P_EW-SR75",
-        "EW-SR12": "P_F_EW_STS12",
-    }
+# Download Data From Saimai as [(item, sku, qty), ...]
+def download_saimai_data(session=None, account=None):
+    account = account or Account()
+    rows = download_google_sheet("Saimai", session, account)
+    if rows is None:
+        return None
 
-    # Download data from Google Sheets
-    df = download_google_sheet("Saimai", "https://docs.google.com/spreadsheets/d/1E5RCU9ZwZurC0KhQ49YangnLDiE0qInP5EPusIxyTsI/export?format=csv&gid=1646174814")
-    
-    df = df.iloc[0:, [1, 2, 6]]  # Select desired rows and columns
-    df.columns = ['SKU', 'Item', 'Qty']  # Rename columns
-    df['Qty'] = df['Qty'].astype(int)  # Convert Qty to int
-    
-    # Add data to `reorganized_inventory`
-    for _, row in df.iterrows():
-        item = row['Item']
-        original_sku = row['SKU']
-        qty = row['Qty']
-        
-        # Map SKU if it exists in mapping, otherwise use original SKU
-        mapped_sku = sku_mapping.get(original_sku, original_sku)
+    # Skip rows without an item or SKU (blank trailing rows), then map SKU if it exists in mapping
+    return [(item, account.saimai_sku_mapping.get(sku, sku), qty) for item, sku, qty in rows if pd.notna(item) and pd.notna(sku)]
 
-        if item not in reorganized_inventory:
-            reorganized_inventory[item] = {
-                "SKU": mapped_sku,
-                "Branch": dict()
-            }
-        reorganized_inventory[item]["Branch"]['Saimai'] = qty
-        
+def apply_saimai_data(reorganized_inventory, rows):
+    apply_branch_rows(reorganized_inventory, 'Saimai', rows)
     logging.info("Processed Saimai data and added to inventory")
 
-# Process all data
-def process_data():
-    # Process ChocoCard data first
-    reorganized_inventory = download_chococard_data()
-    
-    # Process API data (ZORT)
-    logging.info("Processing API data...")
-    api_data = fetch_api_data()
-    if 'list' in api_data:
-        for product in api_data['list']:
-            sku = product['sku']
-            qty = float(product['availablestock'])
-
-            # Check for SKU in reorganized inventory
-            sku_found = False
-            for item_key in list(reorganized_inventory.keys()):
-                if reorganized_inventory[item_key]["SKU"] == sku:
-                    reorganized_inventory[item_key]["Branch"]['On Time'] = qty
-                    sku_found = True
-                    break
-            
-            # If SKU not found, create new entry
-            if not sku_found:
-                new_key = next((k for k, v in reorganized_inventory.items() 
-                              if v["SKU"] == sku), sku)
-                if new_key not in reorganized_inventory:
-                    reorganized_inventory[new_key] = {
-                        "SKU": sku,
-                        "Branch": {'On Time': qty}
-                    }
-
-    # Process Google Sheets data
-    logging.info("Processing HQ data...")
-    process_hq_data(reorganized_inventory)
-    
-    # Process Saimai data
-    logging.info("Processing Saimai data...")
-    process_saimai_data(reorganized_inventory)
+VEND_LOGIN_URL = 'https://www.worldwidevending-vms.com/sys/login.do'
+VEND_EXPORT_URL = 'https://www.worldwidevending-vms.com/op/export_inventory_batch.do'
+
+# Machines per export request and number of export requests in flight
+VEND_BATCH_SIZE = 10
+VEND_MAX_WORKERS = 4
+
+# Vending export layout: header on row 3, positional columns for machine location, SKU and Qty
+VEND_LAYOUT = {"header": 2, "branch": 2, "sku": 3, "qty": 7}
+
+# Log in to the vending machine system, returns the session or None
+def vending_login(account=None):
+    account = account or Account()
+    session = requests.Session()
+
+    # Perform login
+    login_data = {
+        'loginname': account.vend_username,
+        'loginpwd': account.vend_password
+    }
+    response = rate_limiter.request(session, 'POST', VEND_LOGIN_URL, data=login_data)
+
+    if response.status_code != 200:
+        logging.error(f"Vending login failed. Status code: {response.status_code}")
+        return None
+
+    logging.info("Vending login successful")
+    return session
+
+# Export one batch of machines as [(branch, sku, qty), ...]
+@retry(max_retries=3, delay=5)
+def download_vending_batch(session, machines):
+    response = rate_limiter.request(session, 'POST', VEND_EXPORT_URL, data={'selectRow': machines})
+    if response.status_code != 200:
+        raise Exception(f"Error receiving Excel data: HTTP Status {response.status_code}")
+
+    # Read only the needed columns and convert them column-wise
+    columns = [VEND_LAYOUT["branch"], VEND_LAYOUT["sku"], VEND_LAYOUT["qty"]]
+    df = pd.read_excel(BytesIO(response.content), engine='openpyxl', header=VEND_LAYOUT["header"], usecols=columns)
+    df = df.dropna(how='all')
+    return [
+        (branch, sku, parse_qty(qty))
+        for branch, sku, qty in zip(df.iloc[:, 0], df.iloc[:, 1], df.iloc[:, 2])
+        if pd.notna(branch) and pd.notna(sku)
+    ]
+
+# Download Vending Machine data as [(branch, sku, qty), ...], machines are exported in parallel batches
+def download_vending_data(session=None, account=None):
+    logging.info("Starting Vending Machine data download...")
+    account = account or Account()
+    vend_machines = account.vend_machines
+    if not vend_machines:
+        return []
+
+    if session is None:
+        session = vending_login(account)
+        if session is None:
+            return None
+
+    batches = [vend_machines[i:i + VEND_BATCH_SIZE] for i in range(0, len(vend_machines), VEND_BATCH_SIZE)]
+    with ThreadPoolExecutor(max_workers=min(VEND_MAX_WORKERS, len(batches))) as executor:
+        results = list(executor.map(lambda batch: download_vending_batch(session, batch), batches))
+
+    if all(batch_rows is None for batch_rows in results):
+        logging.error("Unable to download Vending Machine data")
+        return None
+
+    rows = []
+    for batch, batch_rows in zip(batches, results):
+        if batch_rows is None:
+            logging.error(f"Unable to download Vending Machine data for {', '.join(batch)}")
+        else:
+            rows.extend(batch_rows)
+    logging.info(f"Vending Machine data received for {len(vend_machines)} machines")
+    return rows
+
+def apply_vending_data(reorganized_inventory, rows):
+    upsert_sku_rows(reorganized_inventory, rows)
+    logging.info("Finished processing Vending Machine data")
+
+# Inventory sources in merge order: name -> (download, apply)
+SOURCES = {
+    "chococard": (download_chococard_data, apply_chococard_data),
+    "zort": (download_zort_data, apply_zort_data),
+    "vending": (download_vending_data, apply_vending_data),
+    "hq": (download_hq_data, apply_hq_data),
+    "saimai": (download_saimai_data, apply_saimai_data),
+}
+
+# Sources whose failure is logged instead of aborting the run
+OPTIONAL_SOURCES = {"vending"}
+
+# Sources that need a logged-in session
+SOURCE_LOGINS = {
+    "chococard": chococard_login,
+    "vending": vending_login,
+}
+
+# Settings an Account accepts, batch.py documents them for account configs
+ACCOUNT_KEYS = {
+    "chococard_username", "chococard_password", "vending_username", "vending_password",
+    "zort_storename", "zort_apikey", "zort_apisecret", "vending_machines",
+    "chococard_branches", "sheets", "saimai_sku_mapping", "sources", "canonical", "deadline",
+}
+
+class Account:
+    """
+    Credentials, source settings and output paths of one inventory run.
+    Settings left out fall back to the .env credentials and the tables above. Without output_dir
+    the outputs go where main.py writes them: inventory_data.json and search_index.json in the
+    working directory, data/ and cache/ next to this file.
+    """
+
+    def __init__(self, name="default", output_dir=None, **settings):
+        unknown = set(settings) - ACCOUNT_KEYS
+        if unknown:
+            raise ValueError(f"Unknown settings {', '.join(sorted(unknown))}")
+        unknown = set(settings.get("sources", SOURCES)) - set(SOURCES)
+        if unknown:
+            raise ValueError(f"Unknown sources {', '.join(sorted(unknown))}")
+        unknown = set(settings.get("sheets", {})) - set(SHEET_LAYOUTS)
+        if unknown:
+            raise ValueError(f"Unknown sheets {', '.join(sorted(unknown))}")
+
+        self.name = name
+        self.choco_username = settings.get("chococard_username", choco_username)
+        self.choco_password = settings.get("chococard_password", choco_password)
+        self.vend_username = settings.get("vending_username", vend_username)
+        self.vend_password = settings.get("vending_password", vend_password)
+        self.zort_storename = settings.get("zort_storename", zort_storename)
+        self.zort_apikey = settings.get("zort_apikey", zort_apikey)
+        self.zort_apisecret = settings.get("zort_apisecret", zort_apisecret)
+        self.vend_machines = list(settings.get("vending_machines", vend_machines))
+        self.chococard_branches = {branch: tuple(ids) for branch, ids in settings.get("chococard_branches", CHOCOCARD_BRANCHES).items()}
+        self.sheet_layouts = {branch: {**layout, **settings.get("sheets", {}).get(branch, {})} for branch, layout in SHEET_LAYOUTS.items()}
+        self.saimai_sku_mapping = dict(settings.get("saimai_sku_mapping", SAIMAI_SKU_MAPPING))
+        self.sources = [source for source in SOURCES if source in settings.get("sources", SOURCES)]
+        self.branch_order = [*self.chococard_branches, "On Time", "HQ", "Saimai"]
+        self.canonical = settings.get("canonical", canonical_export)
+        self.deadline = settings.get("deadline", run_deadline)
+
+        self.output_dir = output_dir
+        if output_dir is None:
+            self.inventory_path = 'inventory_data.json'
+            self.search_index_path = 'search_index.json'
+            self.data_dir = DATA_DIR
+            self.cache_dir = SOURCE_CACHE_DIR
+        else:
+            self.inventory_path = os.path.join(output_dir, 'inventory_data.json')
+            self.search_index_path = os.path.join(output_dir, 'search_index.json')
+            self.data_dir = os.path.join(output_dir, 'data')
+            self.cache_dir = os.path.join(output_dir, 'cache')
+
+# Merge per-source results into the exported inventory list
+def merge_inventory(source_results):
+    reorganized_inventory = {}
+    for name, (_, apply) in SOURCES.items():
+        if source_results.get(name) is not None:
+            apply(reorganized_inventory, source_results[name])
 
     # Merge entries with same SKU
     merged_inventory = {}
@@ -321,33 +536,176 @@ def process_data():
             merged_inventory[sku]["Branch"].update(details["Branch"])
 
     # Convert to list format
-    result_inventory = list(merged_inventory.values())
+    return list(merged_inventory.values())
+
+# Fixed branch order for canonical exports, branches not listed follow alphabetically
+BRANCH_ORDER = [*CHOCOCARD_BRANCHES, "On Time", "HQ", "Saimai"]
+
+# Sort records by SKU and branches by branch_order, and write whole-number floats (83.0) as ints
+def canonical_inventory(result_inventory, branch_order=BRANCH_ORDER):
+    branch_rank = {branch: rank for rank, branch in enumerate(branch_order)}
+
+    def branch_key(branch_qty):
+        return branch_rank.get(branch_qty[0], len(branch_rank)), branch_qty[0]
+
+    def normalize_qty(qty):
+        return int(qty) if isinstance(qty, float) and qty.is_integer() else qty
+
+    return [
+        {
+            "Item": record["Item"],
+            "SKU": record["SKU"],
+            "Branch": {branch: normalize_qty(qty) for branch, qty in sorted(record["Branch"].items(), key=branch_key)}
+        }
+        for record in sorted(result_inventory, key=lambda record: str(record["SKU"]))
+    ]
+
+# Write a snapshot, the canonical layout puts one record per line so git diffs stay line-level
+def write_inventory_json(final_result, filename, canonical):
+    with open(filename, 'w', encoding='utf-8') as json_file:
+        if not canonical:
+            json.dump(final_result, json_file, ensure_ascii=False, separators=(',', ':'))
+            return
+        json_file.write(f'{{"last_updated":{json.dumps(final_result["last_updated"])},"inventory":[\n')
+        json_file.write(',\n'.join(json.dumps(record, ensure_ascii=False, separators=(',', ':')) for record in final_result["inventory"]))
+        json_file.write('\n]}\n')
+
+# Compare a merged inventory with the exported inventory_data.json, True when it differs or is missing
+def inventory_changed(result_inventory, canonical=None, account=None):
+    account = account or Account()
+    if canonical is None:
+        canonical = account.canonical
+    if canonical:
+        result_inventory = canonical_inventory(result_inventory, account.branch_order)
+    try:
+        with open(account.inventory_path, encoding='utf-8') as json_file:
+            previous = json.load(json_file)["inventory"]
+    except (OSError, ValueError, KeyError, TypeError):
+        return True
+    # Round-trip through JSON so tuples and ints/floats compare the way they were written
+    return json.loads(json.dumps(result_inventory, ensure_ascii=False)) != previous
+
+# Write inventory_data.json and a timestamped copy in /data, returns the written paths
+# With snapshot=False only inventory_data.json and the search index are updated
+def export_inventory(result_inventory, canonical=None, snapshot=True, account=None):
+    now = datetime.now(bangkok_tz)
+    account = account or Account()
+    if canonical is None:
+        canonical = account.canonical
+    if canonical:
+        result_inventory = canonical_inventory(result_inventory, account.branch_order)
 
     # Export Inventory Data
-    json_filename = 'inventory_data.json'
+    json_filename = account.inventory_path
     final_result = {
-        "last_updated": datetime.now(bangkok_tz).strftime("%Y-%m-%d %H:%M:%S"),  # Use Bangkok timezone
+        "last_updated": now.strftime("%Y-%m-%d %H:%M:%S"),  # Use Bangkok timezone
         "inventory": result_inventory
     }
-    with open(json_filename, 'w', encoding='utf-8') as json_file:
-        json.dump(final_result, json_file, ensure_ascii=False, separators=(',', ':'))
+    write_inventory_json(final_result, json_filename, canonical)
 
     logging.info(f"Inventory data exported to {json_filename}")
-    
-    # Save another file to /data
-    data_folder = os.path.join(os.path.dirname(__file__), 'data')
-    os.makedirs(data_folder, exist_ok=True)
-
-    # Generate filename with DDMMYY_Timestamp
-    timestamp = datetime.now(bangkok_tz).strftime("%H%M%S")
-    date_str = datetime.now(bangkok_tz).strftime("%d%m%y")
-    data_json_filename = os.path.join(data_folder, f"{date_str}_{timestamp}.json")
-
-    # Write the inventory to the new JSON file
-    with open(data_json_filename, 'w', encoding='utf-8') as json_file:
-        json.dump(final_result, json_file, ensure_ascii=False, separators=(',', ':'))
+    produced = [json_filename]
+
+    if snapshot:
+        # Save another file to /data
+        os.makedirs(account.data_dir, exist_ok=True)
+
+        # Generate filename with DDMMYY_Timestamp
+        data_json_filename = os.path.join(account.data_dir, f"{now.strftime('%d%m%y')}_{now.strftime('%H%M%S')}.json")
+
+        # Write the inventory to the new JSON file
+        write_inventory_json(final_result, data_json_filename, canonical)
+
+        logging.info(f"Inventory data exported to {data_json_filename}")
+        produced.append(data_json_filename)
+
+    # Prebuilt search index for the latest snapshot, updated in place
+    search_index_filename = account.search_index_path
+    changed = write_search_index(result_inventory, search_index_filename)
+    logging.info(f"Search index {search_index_filename} updated ({changed} items reindexed)")
+    produced.append(search_index_filename)
+
+    if snapshot:
+        # Keep a copy of the index next to the snapshot it was built for
+        snapshot_index_filename = data_json_filename[:-len('.json')] + INDEX_SUFFIX
+        shutil.copyfile(search_index_filename, snapshot_index_filename)
+        produced.append(snapshot_index_filename)
+    return produced
+
+# Last good results are kept per source in the account's cache directory
+def save_last_good(name, result, account=None):
+    cache_dir = (account or Account()).cache_dir
+    os.makedirs(cache_dir, exist_ok=True)
+    with open(os.path.join(cache_dir, f"{name}.json"), 'w', encoding='utf-8') as file:
+        json.dump(result, file, ensure_ascii=False, separators=(',', ':'))
+
+def load_last_good(name, account=None):
+    try:
+        with open(os.path.join((account or Account()).cache_dir, f"{name}.json"), encoding='utf-8') as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return None
+
+# Fill a failed source, or missing ChocoCard branches, from the last good result and save
+# fresh results. Sources filled from stale data are appended to `stale`
+def fill_from_last_good(name, result, stale, account=None):
+    account = account or Account()
+    if name == "chococard" and result is not None and len(result) < len(account.chococard_branches):
+        # Fill only the branches that failed
+        last_good = load_last_good(name, account) or {}
+        missing = [branch for branch in account.chococard_branches if branch not in result and branch in last_good]
+        result.update({branch: last_good[branch] for branch in missing})
+        if missing:
+            stale.append(f"{name} ({', '.join(missing)})")
+
+    if result is None:
+        result = load_last_good(name, account)
+        if result is not None:
+            stale.append(name)
+    else:
+        save_last_good(name, result, account)
+    return result
+
+# Download every source, returns ({source name: rows}, [stale source names])
+# Sources that fail or miss the run deadline are filled from their last good result.
+# `sessions` optionally maps source names to sessions to reuse, other sources open their own
+def download_sources(profiler=None, sessions=None, account=None):
+    account = account or Account()
+    source_results = {}
+    stale = []
+    for name in account.sources:
+        download, _ = SOURCES[name]
+        logging.info(f"Processing {name} data...")
+        with profile_stage(profiler, f"fetch_{name}"):
+            try:
+                result = None if deadline.expired() else download((sessions or {}).get(name), account)
+            except Exception as e:
+                logging.error(f"Downloading {name} failed: {e}")
+                result = None
+
+        result = fill_from_last_good(name, result, stale, account)
+        source_results[name] = result
+        if result is None:
+            if name not in OPTIONAL_SOURCES:
+                raise RuntimeError(f"No data received from {name}")
+            logging.error(f"No data received from {name}, continuing without it")
+
+    if stale:
+        logging.warning(f"Stale data filled from the last good results: {', '.join(stale)}")
+    return source_results, stale
+
+# Profile a stage when profiling is enabled, otherwise do nothing
+def profile_stage(profiler, name):
+    return profiler.stage(name) if profiler is not None else nullcontext()
 
-    logging.info(f"Inventory data exported to {data_json_filename}")
+# Process all data
+def process_data(profiler=None, account=None):
+    account = account or Account()
+    source_results, _ = download_sources(profiler, account=account)
+    with profile_stage(profiler, "merge"):
+        result_inventory = merge_inventory(source_results)
+    with profile_stage(profiler, "export"):
+        export_inventory(result_inventory, account=account)
     
     # Send notification when file creation is complete
     timestamp = datetime.now(bangkok_tz).strftime('%d%m%y - %H:%M:%S')
@@ -360,7 +718,7 @@ def generate_file_list(data_directory='./data'):
 
     # Iterate over files in the specified directory
     for filename in os.listdir(data_directory):
-        if filename.endswith('.json') and filename != 'file_list.json':
+        if filename.endswith('.json') and filename != 'file_list.json' and not filename.endswith(INDEX_SUFFIX):
             json_files.append(filename)
 
     # Sort the json_files by date and time extracted from the filename
@@ -374,11 +732,30 @@ def generate_file_list(data_directory='./data'):
         json.dump(json_files, file, ensure_ascii=False, separators=(',', ':'))
 
     print(f"Generated {file_list_path} with {len(json_files)} JSON files.")
-
-# Run the functions
-try:
-    logging.info(f"Today's date is {datetime.now(bangkok_tz).strftime('%Y-%m-%d')}")
-    process_data()
-finally:
-    # Generate JSON List in /data
-    generate_file_list()
\ No newline at end of file
+    return file_list_path
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Download inventory from every source and export it to JSON")
+    parser.add_argument('--profile', action='store_true', help="profile each stage and write reports to profiles/<timestamp>/")
+    parser.add_argument('--canonical', action='store_true', help="write snapshots sorted by SKU with one record per line (same as CANONICAL_EXPORT=1)")
+    parser.add_argument('--deadline', type=float, default=run_deadline, help="time budget for the run in seconds (default: RUN_DEADLINE or 1200)")
+    args = parser.parse_args()
+    if args.canonical:
+        canonical_export = True
+    deadline.start(args.deadline)
+
+    profiler = None
+    if args.profile:
+        from profiler import Profiler
+        profile_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'profiles', datetime.now(bangkok_tz).strftime('%d%m%y_%H%M%S'))
+        profiler = Profiler(profile_dir)
+
+    # Run the functions
+    try:
+        logging.info(f"Today's date is {datetime.now(bangkok_tz).strftime('%Y-%m-%d')}")
+        process_data(profiler)
+    finally:
+        # Generate JSON List in /data
+        generate_file_list()
+        if profiler is not None:
+            profiler.finish()
\ No newline at end of file
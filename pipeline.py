@@ -0,0 +1,81 @@
+import logging
+import time
+from datetime import datetime
+
+import deadline
+import main
+from git_push import git_push_with_timestamp
+
+# Each stage reads from and writes to the shared run context
+def stage_fetch(context):
+    context["source_results"], context["stale"] = main.download_sources(sessions=context["sessions"], account=context["account"])
+
+def stage_merge(context):
+    context["inventory"] = main.merge_inventory(context["source_results"])
+    context["changed"] = main.inventory_changed(context["inventory"], account=context["account"])
+
+def stage_export(context):
+    context["produced"].extend(main.export_inventory(context["inventory"], account=context["account"]))
+
+def stage_manifest(context):
+    context["produced"].append(main.generate_file_list(context["account"].data_dir))
+
+def stage_publish(context):
+    # Only stage the files this run wrote; git is skipped when none of them changed
+    context["published"] = git_push_with_timestamp(context["produced"])
+
+STAGES = [
+    ("fetch", stage_fetch),
+    ("merge", stage_merge),
+    ("export", stage_export),
+    ("manifest", stage_manifest),
+    ("publish", stage_publish),
+]
+
+# Stages skipped when the merged inventory equals the exported inventory_data.json
+SKIP_WHEN_UNCHANGED = {"export", "manifest", "publish"}
+
+def run_stage(context, name, stage, profiler):
+    start = time.perf_counter()
+    try:
+        with main.profile_stage(profiler, name):
+            stage(context)
+    finally:
+        context["timings"][name] = time.perf_counter() - start
+        logging.info(f"Stage {name} finished in {context['timings'][name]:.2f}s")
+
+def run_pipeline(publish=True, profiler=None, deadline_seconds=None, sessions=None, account=None):
+    """
+    Run fetch -> merge -> export -> manifest -> publish in a single process.
+    `account` (a main.Account) holds the settings and output paths, by default main.py's.
+    Returns the run context, including the files produced, the sources filled from stale
+    data and per-stage timings in seconds.
+    """
+    account = account or main.Account()
+    context = {"produced": [], "timings": {}, "sessions": sessions, "changed": True, "account": account}
+    deadline.start(account.deadline if deadline_seconds is None else deadline_seconds)
+    logging.info(f"Today's date is {datetime.now(main.bangkok_tz).strftime('%Y-%m-%d')}")
+
+    try:
+        for name, stage in STAGES:
+            if name == "publish" and not publish:
+                continue
+            if name in SKIP_WHEN_UNCHANGED and not context["changed"]:
+                logging.info(f"Inventory unchanged, skipping stage {name}")
+                continue
+            run_stage(context, name, stage, profiler)
+    except Exception:
+        # Keep data/file_list.json in step with data/ when a stage fails, as main.py does
+        if "manifest" not in context["timings"]:
+            stage_manifest(context)
+        raise
+    finally:
+        if profiler is not None:
+            profiler.finish()
+
+    total = sum(context["timings"].values())
+    logging.info(f"Pipeline finished in {total:.2f}s")
+    return context
+
+if __name__ == "__main__":
+    run_pipeline()
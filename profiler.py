@@ -0,0 +1,127 @@
+import cProfile
+import io
+import json
+import logging
+import os
+import pstats
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter
+from contextlib import contextmanager
+
+def frame_label(code):
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+def idle_worker(code):
+    # Pool threads blocked on their work queue between tasks
+    return code.co_name == "_worker" and os.path.basename(code.co_filename) == "thread.py"
+
+class StackSampler(threading.Thread):
+    """
+    Samples the stacks of every thread at a fixed interval and counts collapsed stacks,
+    each rooted at its thread name so work done in pools (vending exports, hedged
+    requests) shows up next to the calling thread's waits. Idle pool threads are skipped.
+    """
+
+    def __init__(self, interval):
+        super().__init__(daemon=True)
+        self.interval = interval
+        self.counts = Counter()
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == self.ident or idle_worker(frame.f_code):
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(frame_label(frame.f_code))
+                    frame = frame.f_back
+                stack.append(names.get(thread_id, f"thread-{thread_id}"))
+                self.counts[";".join(reversed(stack))] += 1
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+class Profiler:
+    """
+    Profiles named pipeline stages. For each stage it writes:
+    - <stage>.collapsed: sampled stacks of all threads in flamegraph.pl / speedscope collapsed format
+    - <stage>.top.txt: cProfile functions of the calling thread sorted by cumulative and own time
+    and summary.json with wall time and tracemalloc peak per stage.
+    Nested stages are folded into the outer one.
+    """
+
+    def __init__(self, output_dir, interval=0.005, top_n=30):
+        self.output_dir = output_dir
+        self.interval = interval
+        self.top_n = top_n
+        self.summary = {}
+        self.collapsed = Counter()
+        self.active = False
+        os.makedirs(output_dir, exist_ok=True)
+
+    @contextmanager
+    def stage(self, name):
+        if self.active:
+            yield
+            return
+        self.active = True
+
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+        tracemalloc.reset_peak()
+        memory_before = tracemalloc.get_traced_memory()[0]
+
+        sampler = StackSampler(self.interval)
+        profile = cProfile.Profile()
+        sampler.start()
+        start = time.perf_counter()
+        profile.enable()
+        try:
+            yield
+        finally:
+            profile.disable()
+            elapsed = time.perf_counter() - start
+            sampler.stop()
+            current, peak = tracemalloc.get_traced_memory()
+            self.active = False
+
+            self.summary[name] = {
+                "seconds": round(elapsed, 4),
+                "peak_alloc_bytes": peak - memory_before,
+                "retained_bytes": current - memory_before,
+                "samples": sum(sampler.counts.values()),
+            }
+            for stack, count in sampler.counts.items():
+                self.collapsed[f"{name};{stack}"] += count
+            self.write_stage(name, profile, sampler.counts)
+            logging.info(f"Profiled stage {name}: {elapsed:.2f}s, peak {peak - memory_before:,} bytes")
+
+    def write_stage(self, name, profile, counts):
+        with open(os.path.join(self.output_dir, f"{name}.collapsed"), 'w', encoding='utf-8') as file:
+            for stack, count in counts.most_common():
+                file.write(f"{stack} {count}\n")
+
+        report = io.StringIO()
+        stats = pstats.Stats(profile, stream=report)
+        stats.sort_stats('cumulative').print_stats(self.top_n)
+        stats.sort_stats('tottime').print_stats(self.top_n)
+        with open(os.path.join(self.output_dir, f"{name}.top.txt"), 'w', encoding='utf-8') as file:
+            file.write(report.getvalue())
+
+    def finish(self):
+        """Write summary.json and all.collapsed (every stage under its own root frame)."""
+        with open(os.path.join(self.output_dir, "all.collapsed"), 'w', encoding='utf-8') as file:
+            for stack, count in self.collapsed.most_common():
+                file.write(f"{stack} {count}\n")
+        with open(os.path.join(self.output_dir, "summary.json"), 'w', encoding='utf-8') as file:
+            json.dump(self.summary, file, ensure_ascii=False, indent=4)
+        if tracemalloc.is_tracing():
+            tracemalloc.stop()
+        logging.info(f"Profile written to {self.output_dir}")
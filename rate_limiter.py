@@ -0,0 +1,288 @@
+import logging
+import os
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlparse
+
+import requests
+
+import deadline
+
+# Per-host limits: requests per second, bucket size and concurrency bounds
+HOST_LIMITS = {
+    "mychococard.com": {"rate": 1.0, "burst": 1, "max_concurrency": 4},
+    "open-api.zortout.com": {"rate": 1.0, "burst": 2, "max_concurrency": 2},
+    "docs.google.com": {"rate": 2.0, "burst": 4, "max_concurrency": 4},
+    "www.worldwidevending-vms.com": {"rate": 1.0, "burst": 2, "max_concurrency": 4},
+}
+DEFAULT_LIMITS = {"rate": 2.0, "burst": 2, "max_concurrency": 4}
+
+# A response slower than this multiple of the average latency of its request kind counts as congestion
+LATENCY_BACKOFF_FACTOR = 2.0
+
+# A hedged request fires its duplicate after this multiple of its request kind's average latency
+HEDGE_LATENCY_FACTOR = 3.0
+HEDGE_MIN_DELAY = 2.0
+
+# How often a process waiting for a host slot held by another process checks again
+SHARED_POLL_INTERVAL = 0.1
+
+class SharedBuckets:
+    """
+    Per-host token buckets, in-flight counts and Retry-After blocks kept in a multiprocessing.Manager,
+    so every process of a pool draws from the host's full limits instead of a fixed share of them.
+    Create one in the parent and hand it to use_shared_buckets in each process.
+    """
+
+    def __init__(self, manager):
+        self.state = manager.dict()
+        self.lock = manager.Lock()
+
+    def take(self, host, rate, burst, max_concurrency):
+        """Take a token and an in-flight slot for `host`, returns 0 or the seconds to wait before trying again."""
+        with self.lock:
+            now = time.time()
+            tokens, updated, in_flight, blocked_until = self.state.get(host, (float(burst), now, 0, 0.0))
+            tokens = min(burst, tokens + (now - updated) * rate)
+            if now < blocked_until:
+                wait_seconds = blocked_until - now
+            elif in_flight >= max_concurrency:
+                wait_seconds = SHARED_POLL_INTERVAL
+            elif tokens < 1:
+                wait_seconds = (1 - tokens) / rate
+            else:
+                tokens -= 1
+                in_flight += 1
+                wait_seconds = 0.0
+            self.state[host] = (tokens, now, in_flight, blocked_until)
+            return wait_seconds
+
+    def give_back(self, host, burst, token=False, retry_after=None):
+        """Free the in-flight slot taken for `host`, with its token if the request was never sent."""
+        with self.lock:
+            tokens, updated, in_flight, blocked_until = self.state[host]
+            if token:
+                tokens = min(burst, tokens + 1)
+            if retry_after:
+                blocked_until = max(blocked_until, time.time() + retry_after)
+            self.state[host] = (tokens, updated, in_flight - 1, blocked_until)
+
+class HostLimiter:
+    """
+    Token bucket plus an AIMD concurrency window for a single host.
+    The window grows by roughly one slot per window of healthy responses and is halved on
+    429/5xx responses, connection errors or a latency spike. Retry-After blocks the host.
+    Latency is averaged per request kind (see request_kind), so a slow download is not
+    compared against a quick login on the same host.
+    With `shared` (a SharedBuckets) the tokens, the host's concurrency cap and Retry-After
+    blocks are shared with other processes, the AIMD window stays per process.
+    """
+
+    def __init__(self, host, rate, burst, max_concurrency, min_concurrency=1, shared=None):
+        self.host = host
+        self.rate = rate
+        self.burst = burst
+        self.min_concurrency = min_concurrency
+        self.max_concurrency = max_concurrency
+        self.concurrency = float(min_concurrency)
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self.in_flight = 0
+        self.blocked_until = 0.0
+        self.latencies = {}
+        self.shared = shared
+        self.condition = threading.Condition()
+
+    def _refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self, extra=0):
+        # `extra` lets a hedged duplicate run one slot over the window instead of queueing behind the slow request
+        with self.condition:
+            while True:
+                # Never wait for a slot past the run deadline
+                deadline.check()
+                left = deadline.remaining()
+                now = time.monotonic()
+                self._refill(now)
+                if now < self.blocked_until:
+                    self.condition.wait(min(self.blocked_until - now, left if left is not None else float('inf')))
+                elif self.in_flight >= int(self.concurrency) + extra:
+                    self.condition.wait(left)
+                elif self.shared is not None:
+                    wait_seconds = self.shared.take(self.host, self.rate, self.burst, self.max_concurrency + extra)
+                    if wait_seconds:
+                        self.condition.wait(min(wait_seconds, left if left is not None else float('inf')))
+                    else:
+                        self.in_flight += 1
+                        return
+                elif self.tokens < 1:
+                    self.condition.wait(min((1 - self.tokens) / self.rate, left if left is not None else float('inf')))
+                else:
+                    self.tokens -= 1
+                    self.in_flight += 1
+                    return
+
+    def cancel(self):
+        """Give back a slot that was acquired but never used."""
+        with self.condition:
+            self.in_flight -= 1
+            self.tokens = min(self.burst, self.tokens + 1)
+            if self.shared is not None:
+                self.shared.give_back(self.host, self.burst, token=True)
+            self.condition.notify_all()
+
+    def release(self, elapsed, status_code=None, retry_after=None, kind=None):
+        with self.condition:
+            self.in_flight -= 1
+            latency = self.latencies.get(kind)
+            congested = status_code is None or status_code == 429 or status_code >= 500
+            if not congested and latency is not None and elapsed > latency * LATENCY_BACKOFF_FACTOR:
+                congested = True
+
+            if congested:
+                self.concurrency = max(self.min_concurrency, self.concurrency / 2)
+                logging.debug(f"Backing off {self.host}: concurrency {self.concurrency:.1f}")
+            else:
+                self.concurrency = min(self.max_concurrency, self.concurrency + 1 / self.concurrency)
+
+            if status_code is not None:
+                self.latencies[kind] = elapsed if latency is None else 0.8 * latency + 0.2 * elapsed
+
+            if retry_after:
+                logging.warning(f"{self.host} asked to retry after {retry_after:.0f}s")
+                self.blocked_until = max(self.blocked_until, time.monotonic() + retry_after)
+            if self.shared is not None:
+                self.shared.give_back(self.host, self.burst, retry_after=retry_after)
+            self.condition.notify_all()
+
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+# Processes fetching from the same hosts at once, each gets an equal share of the limits
+_processes = 1
+
+# Buckets shared with the other processes of a pool, see use_shared_buckets
+_shared = None
+
+def share_limits(processes):
+    """Split every host's rate, burst and concurrency between `processes` processes."""
+    global _processes
+    with _limiters_lock:
+        _processes = max(1, processes)
+        _limiters.clear()
+
+def use_shared_buckets(buckets):
+    """Draw every host's tokens and concurrency from `buckets` (a SharedBuckets), shared with other processes."""
+    global _shared
+    with _limiters_lock:
+        _shared = buckets
+        _limiters.clear()
+
+def get_limiter(host):
+    with _limiters_lock:
+        if host not in _limiters:
+            limits = HOST_LIMITS.get(host, DEFAULT_LIMITS)
+            _limiters[host] = HostLimiter(
+                host,
+                rate=limits["rate"] / _processes,
+                burst=max(1, limits["burst"] // _processes),
+                max_concurrency=max(1, limits["max_concurrency"] // _processes),
+                shared=_shared,
+            )
+        return _limiters[host]
+
+def request_kind(method, url):
+    """Method and path with numeric segments folded, e.g. "GET /CRM/v2/Restaurant/*/Inventory/DownloadTemplate/*"."""
+    path = "/".join("*" if segment.isdigit() else segment for segment in urlparse(url).path.split("/"))
+    return f"{method.upper()} {path}"
+
+def parse_retry_after(value):
+    """Return the Retry-After header as seconds, it may be a number or an HTTP date."""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, (parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds())
+    except (TypeError, ValueError):
+        return None
+
+def request(session, method, url, **kwargs):
+    """
+    Send a request through the limiter of the URL's host. `session` may be a Session or the requests module.
+    Connect and read timeouts default to what is left of the run deadline.
+    """
+    return _send(session, method, url, kwargs)
+
+def _send(session, method, url, kwargs, extra=0, sent=None):
+    limiter = get_limiter(urlparse(url).hostname)
+    kind = request_kind(method, url)
+    try:
+        limiter.acquire(extra)
+    finally:
+        # Signals hedged_request that the request left the limiter queue (or failed to)
+        if sent is not None:
+            sent.set()
+    try:
+        kwargs.setdefault('timeout', deadline.request_timeout())
+    except deadline.DeadlineExceeded:
+        limiter.cancel()
+        raise
+    start = time.monotonic()
+    try:
+        response = (session or requests).request(method, url, **kwargs)
+    except Exception:
+        limiter.release(time.monotonic() - start, kind=kind)
+        raise
+    limiter.release(time.monotonic() - start, response.status_code, parse_retry_after(response.headers.get('Retry-After')), kind)
+    return response
+
+_hedge_pool = ThreadPoolExecutor(max_workers=8, thread_name_prefix='hedge')
+
+def _new_hedge_pool():
+    global _hedge_pool
+    _hedge_pool = ThreadPoolExecutor(max_workers=8, thread_name_prefix='hedge')
+
+# Threads do not survive fork, a forked worker (job_queue, batch) would queue hedged requests on a pool without threads
+os.register_at_fork(after_in_child=_new_hedge_pool)
+
+def _close_response(future):
+    if not future.cancelled() and future.exception() is None:
+        future.result().close()
+
+def hedged_request(session, method, url, **kwargs):
+    """
+    Send an idempotent request and, if it has not answered within a few times the usual
+    latency of its kind, send a duplicate and keep whichever response arrives first.
+    """
+    latency = get_limiter(urlparse(url).hostname).latencies.get(request_kind(method, url))
+    hedge_delay = HEDGE_MIN_DELAY if latency is None else max(HEDGE_MIN_DELAY, latency * HEDGE_LATENCY_FACTOR)
+
+    sent = threading.Event()
+    pending = {_hedge_pool.submit(_send, session, method, url, dict(kwargs), 0, sent)}
+    # The hedge delay starts once the request got its limiter slot, time queued behind
+    # the host's rate limit is not a slow response
+    sent.wait()
+    done, _ = wait(pending, timeout=hedge_delay)
+    if not done and not deadline.expired():
+        logging.info(f"Hedging slow request to {url}")
+        pending.add(_hedge_pool.submit(_send, session, method, url, dict(kwargs), 1))
+
+    error = None
+    while pending:
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        winner = next((future for future in done if future.exception() is None), None)
+        if winner is not None:
+            # Close the losing response whenever it finishes
+            for other in (done | pending) - {winner}:
+                other.add_done_callback(_close_response)
+            return winner.result()
+        error = next(iter(done)).exception()
+    raise error
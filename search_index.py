@@ -0,0 +1,259 @@
+import bisect
+import itertools
+import json
+import os
+import re
+import sys
+import unicodedata
+
+INDEX_VERSION = 2
+
+# Per-snapshot copies are written next to data/<stamp>.json as data/<stamp>.index.json
+INDEX_SUFFIX = '.index.json'
+
+# Length of the character n-grams used for substring matching
+GRAM_SIZE = 3
+
+# Zero-width characters that show up in copied Thai product names
+ZERO_WIDTH = dict.fromkeys(map(ord, "\u200b\u200c\u200d\u2060\ufeff"))
+
+# Latin/digit/Thai letters plus Thai vowel and tone marks, everything else separates tokens
+TOKEN_PATTERN = re.compile(r"[0-9a-z\u0e01-\u0e3a\u0e40-\u0e4e]+")
+
+def normalize(text):
+    """
+    Normalize text for matching: NFKC (which also folds Thai SARA AM written as
+    NIKHAHIT + SARA AA and full-width Latin), case folding and zero-width removal.
+    """
+    if not isinstance(text, str):
+        text = "" if text is None else str(text)
+    text = unicodedata.normalize("NFKC", text).translate(ZERO_WIDTH).casefold()
+    # Drop Latin accents so "crème" matches "creme", Thai marks are kept as they change meaning
+    return "".join(c for c in unicodedata.normalize("NFKD", text) if not "\u0300" <= c <= "\u036f")
+
+def tokenize(text):
+    return TOKEN_PATTERN.findall(normalize(text))
+
+def grams(token):
+    if len(token) < GRAM_SIZE:
+        return {token}
+    return {token[i:i + GRAM_SIZE] for i in range(len(token) - GRAM_SIZE + 1)}
+
+def encode_postings(ids):
+    gaps = []
+    previous = 0
+    for doc_id in sorted(ids):
+        gaps.append(doc_id - previous)
+        previous = doc_id
+    return gaps
+
+def decode_postings(gaps):
+    return set(itertools.accumulate(gaps))
+
+class SearchIndex:
+    """
+    Token and character n-gram index over item names and SKUs.
+
+    Each SKU gets a stable document id. Query tokens of GRAM_SIZE characters or more are
+    matched anywhere inside item names or SKUs (Thai names have no spaces between words),
+    shorter tokens match as word prefixes. All query tokens must match.
+    """
+
+    def __init__(self):
+        self.docs = []  # doc id -> [sku, item] or None once removed
+        self.doc_ids = {}  # sku -> doc id
+        self.texts = {}  # doc id -> normalized "item sku" used to verify n-gram candidates
+        self.tokens = {}  # token -> set of doc ids
+        self.grams = {}  # n-gram -> set of doc ids
+        self._vocabulary = None
+        self._order = None
+
+    def __len__(self):
+        return len(self.doc_ids)
+
+    def _postings(self, item, sku):
+        doc_tokens = set(tokenize(item)) | set(tokenize(sku))
+        doc_grams = set()
+        for token in doc_tokens:
+            doc_grams |= grams(token)
+        return doc_tokens, doc_grams
+
+    def add(self, sku, item):
+        """Add or replace one SKU, returns True if the index changed."""
+        text = f"{normalize(item)} {normalize(sku)}"
+        doc_id = self.doc_ids.get(sku)
+        if doc_id is not None:
+            if self.texts[doc_id] == text:
+                return False
+            self.remove(sku)
+
+        doc_id = len(self.docs)
+        self.docs.append([sku, item])
+        self.doc_ids[sku] = doc_id
+        self.texts[doc_id] = text
+        doc_tokens, doc_grams = self._postings(item, sku)
+        for token in doc_tokens:
+            self.tokens.setdefault(token, set()).add(doc_id)
+        for gram in doc_grams:
+            self.grams.setdefault(gram, set()).add(doc_id)
+        self._vocabulary = None
+        self._order = None
+        return True
+
+    def remove(self, sku):
+        doc_id = self.doc_ids.pop(sku, None)
+        if doc_id is None:
+            return False
+        old_sku, item = self.docs[doc_id]
+        doc_tokens, doc_grams = self._postings(item, old_sku)
+        for postings, keys in ((self.tokens, doc_tokens), (self.grams, doc_grams)):
+            for key in keys:
+                postings[key].discard(doc_id)
+                if not postings[key]:
+                    del postings[key]
+        self.docs[doc_id] = None
+        del self.texts[doc_id]
+        self._vocabulary = None
+        self._order = None
+        return True
+
+    def update_from_inventory(self, inventory):
+        """Sync the index with an exported inventory list, only changed items are reindexed."""
+        changed = 0
+        current = set()
+        for record in inventory:
+            current.add(record["SKU"])
+            changed += self.add(record["SKU"], record["Item"])
+        for sku in [sku for sku in self.doc_ids if sku not in current]:
+            changed += self.remove(sku)
+        return changed
+
+    @classmethod
+    def from_inventory(cls, inventory):
+        index = cls()
+        index.update_from_inventory(inventory)
+        return index
+
+    def _prefix_matches(self, token):
+        if self._vocabulary is None:
+            self._vocabulary = sorted(self.tokens)
+        matches = set()
+        i = bisect.bisect_left(self._vocabulary, token)
+        while i < len(self._vocabulary) and self._vocabulary[i].startswith(token):
+            matches |= self.tokens[self._vocabulary[i]]
+            i += 1
+        return matches
+
+    def _rank(self):
+        # Position of every document in item-name order, rebuilt lazily after changes
+        if self._order is None:
+            live = [doc_id for doc_id, doc in enumerate(self.docs) if doc is not None]
+            live.sort(key=lambda doc_id: self.texts[doc_id])
+            self._order = {doc_id: position for position, doc_id in enumerate(live)}
+        return self._order
+
+    def search(self, query, limit=None):
+        """Return SKUs matching every token of the query, whole-word matches first."""
+        query_tokens = list(dict.fromkeys(tokenize(query)))
+        if not query_tokens:
+            return []
+
+        # Intersect the postings of every query token at once, rarest first.
+        # Tokens longer than GRAM_SIZE can produce n-gram false positives and are verified below
+        postings = []
+        verify = []
+        for token in query_tokens:
+            if len(token) < GRAM_SIZE:
+                postings.append(self._prefix_matches(token))
+            else:
+                postings.extend(self.grams.get(gram, set()) for gram in grams(token))
+                if len(token) > GRAM_SIZE:
+                    verify.append(token)
+        postings.sort(key=len)
+        results = set(postings[0])
+        for posting in postings[1:]:
+            if not results:
+                return []
+            results &= posting
+
+        # Items where every query token is a whole word come first, each group in name order
+        exact = set(results)
+        for token in query_tokens:
+            exact &= self.tokens.get(token, set())
+        order = self._rank()
+        groups = (sorted(exact, key=order.__getitem__), sorted(results - exact, key=order.__getitem__))
+
+        # Verify n-gram candidates in rank order, stopping once the limit is reached
+        found = []
+        for doc_id in itertools.chain(*groups):
+            text = self.texts[doc_id]
+            if all(token in text for token in verify):
+                found.append(self.docs[doc_id][0])
+                if limit is not None and len(found) >= limit:
+                    break
+        return found
+
+    def item(self, sku):
+        doc_id = self.doc_ids.get(sku)
+        return None if doc_id is None else self.docs[doc_id][1]
+
+    def to_dict(self):
+        # Postings are stored as gaps between sorted doc ids. N-gram postings are not stored:
+        # a document's n-grams are exactly the n-grams of its tokens, so they are rebuilt on load
+        return {
+            "version": INDEX_VERSION,
+            "gram_size": GRAM_SIZE,
+            "docs": self.docs,
+            "tokens": {token: encode_postings(ids) for token, ids in sorted(self.tokens.items())},
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        if data.get("version") != INDEX_VERSION or data.get("gram_size") != GRAM_SIZE:
+            raise ValueError("Unsupported search index format")
+        index = cls()
+        index.docs = data["docs"]
+        for doc_id, doc in enumerate(index.docs):
+            if doc is not None:
+                sku, item = doc
+                index.doc_ids[sku] = doc_id
+                index.texts[doc_id] = f"{normalize(item)} {normalize(sku)}"
+        index.tokens = {token: decode_postings(gaps) for token, gaps in data["tokens"].items()}
+        for token, ids in index.tokens.items():
+            for gram in grams(token):
+                index.grams.setdefault(gram, set()).update(ids)
+        return index
+
+    def save(self, path):
+        with open(path, 'w', encoding='utf-8') as file:
+            json.dump(self.to_dict(), file, ensure_ascii=False, separators=(',', ':'))
+
+    @classmethod
+    def load(cls, path):
+        with open(path, encoding='utf-8') as file:
+            return cls.from_dict(json.load(file))
+
+def write_search_index(inventory, path):
+    """Update the index at `path` from the inventory (rebuilding it if missing or unreadable)."""
+    index = None
+    if os.path.exists(path):
+        try:
+            index = SearchIndex.load(path)
+        except (ValueError, KeyError, TypeError):
+            index = None
+    if index is None:
+        index = SearchIndex()
+    changed = index.update_from_inventory(inventory)
+
+    # Rebuild once removed items outnumber live ones so document ids stay dense
+    if len(index.docs) > 2 * len(index):
+        index = SearchIndex.from_inventory(inventory)
+    index.save(path)
+    return changed
+
+if __name__ == "__main__":
+    # Usage: python search_index.py "curaprox 5460" [search_index.json]
+    index_path = sys.argv[2] if len(sys.argv) > 2 else 'search_index.json'
+    index = SearchIndex.load(index_path)
+    for sku in index.search(sys.argv[1]):
+        print(f"{sku}\t{index.item(sku)}")
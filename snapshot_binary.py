@@ -0,0 +1,248 @@
+import glob
+import json
+import math
+import mmap
+import os
+import struct
+import sys
+import zlib
+
+# Binary snapshot layout (little-endian):
+#   header      see HEADER below, section offsets are from the start of the file
+#   items       string table: u32 offsets[n + 1] followed by the UTF-8 bytes
+#   skus        string table, one SKU per record
+#   branches    string table
+#   records     fixed-width rows: item id, sku id, first entry, entry count
+#   entries     fixed-width quantities: branch id, kind, int32 value
+#   doubles     float64 quantities that are not whole numbers, referenced by entry value
+#   sku index   open-addressing hash table of record number + 1 (0 = empty), keyed by crc32 of the SKU
+#   last_updated UTF-8 string
+MAGIC = b"DRGS"
+VERSION = 1
+HEADER = struct.Struct("<4sHxx5I8II")
+OFFSETS = struct.Struct("<I")
+RECORD = struct.Struct("<IIIHxx")
+ENTRY = struct.Struct("<HBxi")
+FLOAT64 = struct.Struct("<d")
+
+# Quantity kinds, kept so ints and floats ("83.0") convert back to identical JSON
+KIND_INT = 0
+KIND_WHOLE_FLOAT = 1  # float with a whole value stored inline, e.g. ZORT's 83.0
+KIND_NULL = 2
+KIND_DOUBLE = 3  # value is an index into the doubles section
+
+INT32_MIN, INT32_MAX = -2 ** 31, 2 ** 31 - 1
+
+def _encode_qty(qty, doubles):
+    if qty is None:
+        return KIND_NULL, 0
+    if isinstance(qty, bool) or not isinstance(qty, (int, float)):
+        raise ValueError(f"Unsupported quantity {qty!r}")
+    if isinstance(qty, int):
+        if not INT32_MIN <= qty <= INT32_MAX:
+            raise ValueError(f"Quantity {qty} does not fit in 32 bits")
+        return KIND_INT, qty
+    # -0.0 goes to the doubles section, an inline 0 would come back as 0.0
+    if qty.is_integer() and INT32_MIN <= qty <= INT32_MAX and not (qty == 0 and math.copysign(1, qty) < 0):
+        return KIND_WHOLE_FLOAT, int(qty)
+    doubles.append(qty)
+    return KIND_DOUBLE, len(doubles) - 1
+
+def _string_table(strings):
+    blobs = [s.encode('utf-8') for s in strings]
+    offsets = [0]
+    for blob in blobs:
+        offsets.append(offsets[-1] + len(blob))
+    return struct.pack(f"<{len(offsets)}I", *offsets) + b"".join(blobs)
+
+def _dictionary(values, what):
+    ids = {}
+    for value in values:
+        if not isinstance(value, str):
+            raise ValueError(f"{what} must be a string, got {value!r}")
+        ids.setdefault(value, len(ids))
+    return ids
+
+def _hash_size(count):
+    size = 1
+    while size < count * 2:
+        size *= 2
+    return size
+
+def encode_snapshot(snapshot):
+    """Encode a snapshot dict ({"last_updated", "inventory"}) to bytes."""
+    inventory = snapshot["inventory"]
+    item_ids = _dictionary((record["Item"] for record in inventory), "Item")
+    skus = [record["SKU"] for record in inventory]
+    _dictionary(skus, "SKU")
+    branch_ids = _dictionary((branch for record in inventory for branch in record["Branch"]), "Branch")
+    if len(branch_ids) > 0xFFFF:
+        raise ValueError("Too many branches for a binary snapshot")
+
+    records = bytearray()
+    entries = bytearray()
+    doubles = []
+    entry_count = 0
+    for number, record in enumerate(inventory):
+        branches = record["Branch"]
+        records += RECORD.pack(item_ids[record["Item"]], number, entry_count, len(branches))
+        for branch, qty in branches.items():
+            try:
+                kind, value = _encode_qty(qty, doubles)
+            except ValueError as e:
+                raise ValueError(f"{e} for {record['SKU']} at {branch}") from None
+            entries += ENTRY.pack(branch_ids[branch], kind, value)
+            entry_count += 1
+
+    # SKU index with linear probing, SKUs are unique after the merge
+    hash_size = _hash_size(len(skus))
+    table = [0] * hash_size
+    for number, sku in enumerate(skus):
+        slot = zlib.crc32(sku.encode('utf-8')) & (hash_size - 1)
+        while table[slot]:
+            slot = (slot + 1) & (hash_size - 1)
+        table[slot] = number + 1
+
+    sections = [
+        _string_table(item_ids),
+        _string_table(skus),
+        _string_table(branch_ids),
+        bytes(records),
+        bytes(entries),
+        struct.pack(f"<{len(doubles)}d", *doubles),
+        struct.pack(f"<{hash_size}I", *table),
+        snapshot["last_updated"].encode('utf-8'),
+    ]
+    offsets = []
+    position = HEADER.size
+    for section in sections:
+        offsets.append(position)
+        position += len(section)
+
+    header = HEADER.pack(
+        MAGIC, VERSION,
+        len(inventory), len(item_ids), len(branch_ids), entry_count, hash_size,
+        *offsets, len(sections[-1]),
+    )
+    return header + b"".join(sections)
+
+class BinarySnapshot:
+    """
+    Read-only view of a binary snapshot backed by mmap. Opening only reads the header,
+    strings and quantities are decoded on access.
+
+        with BinarySnapshot('data/030426_015322.drgs') as snapshot:
+            snapshot.get('P_EW-INT')
+    """
+
+    def __init__(self, path):
+        with open(path, 'rb') as file:
+            self._mmap = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        (magic, version, self.record_count, self.item_count, self.branch_count, self.entry_count,
+         self._hash_size, items, skus, branches, self._records, self._entries, self._doubles,
+         self._index, last_updated_offset, last_updated_length) = HEADER.unpack_from(self._mmap, 0)
+        if magic != MAGIC or version != VERSION:
+            self._mmap.close()
+            raise ValueError(f"{path} is not a version {VERSION} binary snapshot")
+        # String tables as (offset, number of strings)
+        self._items = (items, self.item_count)
+        self._skus = (skus, self.record_count)
+        self._branches = (branches, self.branch_count)
+        self.last_updated = self._mmap[last_updated_offset:last_updated_offset + last_updated_length].decode('utf-8')
+        self._branch_names = None
+
+    def close(self):
+        self._mmap.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __len__(self):
+        return self.record_count
+
+    def _string(self, table, number):
+        offset, count = table
+        start, end = struct.unpack_from("<II", self._mmap, offset + number * 4)
+        base = offset + (count + 1) * 4
+        return self._mmap[base + start:base + end].decode('utf-8')
+
+    def branches(self):
+        if self._branch_names is None:
+            self._branch_names = [self._string(self._branches, number) for number in range(self.branch_count)]
+        return self._branch_names
+
+    def record(self, number):
+        """Return record `number` in the same shape as the JSON inventory."""
+        item_id, sku_id, first_entry, entry_count = RECORD.unpack_from(self._mmap, self._records + number * RECORD.size)
+        branch_names = self.branches()
+        branches = {}
+        for entry in range(first_entry, first_entry + entry_count):
+            branch_id, kind, value = ENTRY.unpack_from(self._mmap, self._entries + entry * ENTRY.size)
+            if kind == KIND_INT:
+                branches[branch_names[branch_id]] = value
+            elif kind == KIND_WHOLE_FLOAT:
+                branches[branch_names[branch_id]] = float(value)
+            elif kind == KIND_DOUBLE:
+                branches[branch_names[branch_id]] = FLOAT64.unpack_from(self._mmap, self._doubles + value * FLOAT64.size)[0]
+            else:
+                branches[branch_names[branch_id]] = None
+        return {
+            "Item": self._string(self._items, item_id),
+            "SKU": self._string(self._skus, sku_id),
+            "Branch": branches,
+        }
+
+    def get(self, sku, default=None):
+        """Look up one SKU through the hash index without reading other records."""
+        encoded = sku.encode('utf-8')
+        mask = self._hash_size - 1
+        slot = zlib.crc32(encoded) & mask
+        while True:
+            number = OFFSETS.unpack_from(self._mmap, self._index + slot * 4)[0]
+            if number == 0:
+                return default
+            if self._string(self._skus, number - 1) == sku:
+                return self.record(number - 1)
+            slot = (slot + 1) & mask
+
+    def __iter__(self):
+        for number in range(self.record_count):
+            yield self.record(number)
+
+    def to_dict(self):
+        return {"last_updated": self.last_updated, "inventory": list(self)}
+
+def json_to_binary(json_path, binary_path=None):
+    binary_path = binary_path or os.path.splitext(json_path)[0] + '.drgs'
+    with open(json_path, encoding='utf-8') as file:
+        snapshot = json.load(file)
+    with open(binary_path, 'wb') as file:
+        file.write(encode_snapshot(snapshot))
+    return binary_path
+
+def binary_to_json(binary_path, json_path=None):
+    """Write the snapshot back in the compact JSON format app.js reads."""
+    json_path = json_path or os.path.splitext(binary_path)[0] + '.json'
+    with BinarySnapshot(binary_path) as snapshot:
+        data = snapshot.to_dict()
+    with open(json_path, 'w', encoding='utf-8') as file:
+        json.dump(data, file, ensure_ascii=False, separators=(',', ':'))
+    return json_path
+
+if __name__ == "__main__":
+    # Usage: python snapshot_binary.py to-binary data/*.json
+    #        python snapshot_binary.py to-json data/*.drgs
+    #        python snapshot_binary.py get <snapshot.drgs> <SKU>
+    command, *arguments = sys.argv[1:]
+    if command == "get":
+        with BinarySnapshot(arguments[0]) as snapshot:
+            print(json.dumps(snapshot.get(arguments[1]), ensure_ascii=False))
+    else:
+        convert = {"to-binary": json_to_binary, "to-json": binary_to_json}[command]
+        for pattern in arguments:
+            for path in glob.glob(pattern):
+                if os.path.basename(path) != 'file_list.json' and not path.endswith('.index.json'):
+                    print(convert(path))